@@ -5,7 +5,6 @@ from flask import Blueprint, jsonify, request, send_file, abort
 import sys
 import os
 import json
-import importlib.util
 from pathlib import Path
 from datetime import datetime
 from dotenv import load_dotenv
@@ -43,19 +42,14 @@ def get_rubrics_dir():
     return rubrics_dir
 scripts_dir = project_root / 'scripts'
 
-# Import grading_workflow module directly
-grading_workflow_path = scripts_dir / 'grading_workflow.py'
-spec1 = importlib.util.spec_from_file_location("grading_workflow", grading_workflow_path)
-grading_workflow = importlib.util.module_from_spec(spec1)
-spec1.loader.exec_module(grading_workflow)
+# Import the scripts as regular modules so every importer (including
+# grading_workflow's own imports and api/sections.py) shares one copy
+if str(scripts_dir) not in sys.path:
+    sys.path.insert(0, str(scripts_dir))
+import grading_workflow
+import ai_grader
 grade_document = grading_workflow.grade_document
 load_config = grading_workflow.load_config
-
-# Import ai_grader module directly
-ai_grader_path = scripts_dir / 'ai_grader.py'
-spec2 = importlib.util.spec_from_file_location("ai_grader", ai_grader_path)
-ai_grader = importlib.util.module_from_spec(spec2)
-spec2.loader.exec_module(ai_grader)
 load_rubric = ai_grader.load_rubric
 
 grading_bp = Blueprint('grading', __name__)
@@ -208,6 +202,7 @@ def grade_single():
     doc_id = data.get('doc_id')
     rubric_filename = data.get('rubric_filename')
     custom_instructions = data.get('custom_instructions', '').strip() or None
+    force_refresh = bool(data.get('force_refresh', False))
     
     if not doc_id:
         return jsonify({'error': 'doc_id is required'}), 400
@@ -223,7 +218,7 @@ def grade_single():
     
     try:
         config = load_config()
-        result = grade_document(doc_id, str(rubric_path), config, custom_instructions)
+        result = grade_document(doc_id, str(rubric_path), config, custom_instructions, force_refresh=force_refresh)
         return jsonify(result)
     except Exception as e:
         return jsonify({'error': str(e), 'success': False}), 500
@@ -236,6 +231,7 @@ def grade_batch():
     doc_types = data.get('doc_types', {})  # {doc_id: True if Word doc, False if Google Doc}
     rubric_filename = data.get('rubric_filename')
     custom_instructions = data.get('custom_instructions', '').strip() or None
+    force_refresh = bool(data.get('force_refresh', False))
     
     if not doc_ids:
         return jsonify({'error': 'doc_ids is required'}), 400
@@ -249,34 +245,31 @@ def grade_batch():
         return jsonify({'error': f'Rubric not found: {rubric_filename}'}), 404
     
     config = load_config()
-    results = []
     
-    for doc_id in doc_ids:
-        is_word_doc = doc_types.get(doc_id, False)
-        try:
-            # Use grade_document_for_review - doesn't update Google Docs, just returns results
-            result = grading_workflow.grade_document_for_review(doc_id, str(rubric_path), config, custom_instructions, is_word_doc=is_word_doc)
-            results.append({
-                'doc_id': doc_id,
-                'success': result.get('success', False),
-                'total_score': result.get('total_score', 0),
-                'scores': result.get('scores', {}),
-                'strengths': result.get('strengths', ''),
-                'key_issues': result.get('key_issues', ''),
-                'suggestions': result.get('suggestions', ''),
-                'criterion_comments': result.get('criterion_comments', {}),
-                'document_text': result.get('document_text', ''),  # Include document text for review
-                'error': result.get('error'),
-                'converted_doc_id': result.get('converted_doc_id'),  # New Google Doc ID if converted
-                'original_doc_id': result.get('original_doc_id'),  # Original Word doc ID if converted
-                'message': result.get('message', '')
-            })
-        except Exception as e:
-            results.append({
-                'doc_id': doc_id,
-                'success': False,
-                'error': str(e)
-            })
+    try:
+        # Use grade_documents_for_review - doesn't update Google Docs, just returns results
+        graded = grading_workflow.grade_documents_for_review(doc_ids, str(rubric_path), config, custom_instructions,
+                                                             doc_types=doc_types, force_refresh=force_refresh)
+    except Exception as e:
+        graded = [{'success': False, 'error': str(e)} for _ in doc_ids]
+    
+    results = []
+    for doc_id, result in zip(doc_ids, graded):
+        results.append({
+            'doc_id': doc_id,
+            'success': result.get('success', False),
+            'total_score': result.get('total_score', 0),
+            'scores': result.get('scores', {}),
+            'strengths': result.get('strengths', ''),
+            'key_issues': result.get('key_issues', ''),
+            'suggestions': result.get('suggestions', ''),
+            'criterion_comments': result.get('criterion_comments', {}),
+            'document_text': result.get('document_text', ''),  # Include document text for review
+            'error': result.get('error'),
+            'converted_doc_id': result.get('converted_doc_id'),  # New Google Doc ID if converted
+            'original_doc_id': result.get('original_doc_id'),  # Original Word doc ID if converted
+            'message': result.get('message', '')
+        })
     
     return jsonify({'results': results})
 
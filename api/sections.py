@@ -9,8 +9,11 @@ from datetime import datetime
 from pathlib import Path
 import sys
 
-# Add parent directory to path
+# Add parent directory and scripts directory to path (once, at import time)
 sys.path.insert(0, str(Path(__file__).parent.parent))
+scripts_dir = str(Path(__file__).parent.parent / 'scripts')
+if scripts_dir not in sys.path:
+    sys.path.insert(0, scripts_dir)
 
 from models import get_db_session, Section, Assignment, User, GradingSession, AssignmentDocument
 
@@ -52,9 +55,9 @@ def list_assignments(section_id):
                 'status': a.status,
                 'rubric_filename': a.rubric_filename,
                 'drive_folder_id': a.drive_folder_id,
-                'created_at': a.created_at.isoformat() if a.created_at else None,
-                'activated_at': a.activated_at.isoformat() if a.activated_at else None,
-                'completed_at': a.completed_at.isoformat() if a.completed_at else None,
+                'created_at': a.created_at,
+                'activated_at': a.activated_at,
+                'completed_at': a.completed_at,
                 'created_by': a.created_by
             } for a in assignments]
         })
@@ -130,9 +133,9 @@ def get_assignment(assignment_id):
                 'rubric_filename': assignment.rubric_filename,
                 'custom_instructions': assignment.custom_instructions,
                 'drive_folder_id': assignment.drive_folder_id,
-                'created_at': assignment.created_at.isoformat() if assignment.created_at else None,
-                'activated_at': assignment.activated_at.isoformat() if assignment.activated_at else None,
-                'completed_at': assignment.completed_at.isoformat() if assignment.completed_at else None,
+                'created_at': assignment.created_at,
+                'activated_at': assignment.activated_at,
+                'completed_at': assignment.completed_at,
                 'created_by': assignment.created_by
             }
         })
@@ -340,8 +343,8 @@ def get_assignment_documents(assignment_id):
                 'doc_id': doc.doc_id,
                 'doc_name': doc.doc_name,
                 'status': doc.status,
-                'graded_at': doc.graded_at.isoformat() if doc.graded_at else None,
-                'reviewed_at': doc.reviewed_at.isoformat() if doc.reviewed_at else None,
+                'graded_at': doc.graded_at,
+                'reviewed_at': doc.reviewed_at,
                 'session_id': session_info.get('session_id'),
                 'doc_index': session_info.get('doc_index'),
                 'session_status': session_info.get('session_status'),
@@ -376,8 +379,8 @@ def get_grading_history(assignment_id):
                 'doc_ids': json.loads(s.doc_ids),
                 'status': s.status,
                 'reviewed_by': s.reviewed_by,
-                'reviewed_at': s.reviewed_at.isoformat() if s.reviewed_at else None,
-                'created_at': s.created_at.isoformat() if s.created_at else None
+                'reviewed_at': s.reviewed_at,
+                'created_at': s.created_at
             } for s in sessions]
         })
     finally:
@@ -669,7 +672,6 @@ def get_grading_session(session_id):
             
             if rubric_path.exists():
                 try:
-                    sys.path.insert(0, str(Path(__file__).parent.parent / 'scripts'))
                     from ai_grader import load_rubric
                     rubric = load_rubric(str(rubric_path))
                 except Exception as e:
@@ -693,9 +695,9 @@ def get_grading_session(session_id):
                 'name': reviewer.name if reviewer else None,
                 'email': reviewer.email if reviewer else None
             } if reviewer else None,
-            'reviewed_at': grading_session.reviewed_at.isoformat() if grading_session.reviewed_at else None,
+            'reviewed_at': grading_session.reviewed_at,
             'review_notes': grading_session.review_notes,
-            'created_at': grading_session.created_at.isoformat() if grading_session.created_at else None
+            'created_at': grading_session.created_at
         })
     except Exception as e:
         return jsonify({'error': str(e)}), 500
@@ -751,7 +753,6 @@ def approve_grading_session(session_id):
             return jsonify({'error': f'Rubric not found: {assignment.rubric_filename}'}), 404
         
         # Import grading workflow for sync function
-        sys.path.insert(0, str(Path(__file__).parent.parent / 'scripts'))
         from grading_workflow import sync_feedback_to_document, load_rubric, load_config
         
         rubric = load_rubric(str(rubric_path))
@@ -955,7 +956,6 @@ def approve_document(session_id):
             return jsonify({'error': f'Rubric not found: {assignment.rubric_filename}'}), 404
         
         # Import grading workflow for sync function
-        sys.path.insert(0, str(Path(__file__).parent.parent / 'scripts'))
         from grading_workflow import sync_feedback_to_document, load_rubric, load_config
         
         rubric = load_rubric(str(rubric_path))
@@ -2,17 +2,52 @@
 Flask web application for AI Grading System UI
 """
 from flask import Flask, render_template, jsonify
+from flask.json.provider import DefaultJSONProvider
 from flask_cors import CORS
 from werkzeug.middleware.proxy_fix import ProxyFix
 import os
+from datetime import date, datetime
 from pathlib import Path
 from dotenv import load_dotenv
+try:
+    import orjson
+    ORJSON_AVAILABLE = True
+except ImportError:
+    ORJSON_AVAILABLE = False
 
 # Load environment variables from project root .env file
 env_path = Path(__file__).parent / '.env'
 load_dotenv(dotenv_path=env_path)
 
+
+class GraderJSONProvider(DefaultJSONProvider):
+    """JSON provider that serializes datetimes as ISO 8601 strings (via orjson when installed)"""
+    # Naive datetimes are emitted as-is (no 'Z'), matching the .isoformat() strings the API returned before
+    ORJSON_OPTIONS = orjson.OPT_NON_STR_KEYS if ORJSON_AVAILABLE else 0
+
+    @staticmethod
+    def default(o):
+        if isinstance(o, (date, datetime)):
+            return o.isoformat()
+        return DefaultJSONProvider.default(o)
+
+    def dumps(self, obj, **kwargs):
+        if ORJSON_AVAILABLE:
+            option = self.ORJSON_OPTIONS
+            if kwargs.get('sort_keys', self.sort_keys):
+                option |= orjson.OPT_SORT_KEYS
+            if kwargs.get('indent'):
+                option |= orjson.OPT_INDENT_2
+            try:
+                return orjson.dumps(obj, default=self.default, option=option).decode('utf-8')
+            except orjson.JSONEncodeError:
+                # Fall back to stdlib json for anything orjson can't encode
+                pass
+        return super().dumps(obj, **kwargs)
+
+
 app = Flask(__name__)
+app.json = GraderJSONProvider(app)
 # Set secret key for session management (OAuth2)
 app.secret_key = os.getenv('FLASK_SECRET_KEY', 'change-this-secret-key-in-production-' + str(os.urandom(24)))
 
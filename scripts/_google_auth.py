@@ -0,0 +1,124 @@
+"""
+Google API credentials shared by the insert_* scripts.
+Credentials are loaded once per process and refreshed only when close to expiry.
+"""
+import os
+import sys
+import json
+import threading
+from datetime import datetime, timedelta, timezone
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from google.oauth2.credentials import Credentials
+from google.oauth2 import service_account
+from google.auth.transport.requests import Request
+
+try:
+    import orjson
+    ORJSON_AVAILABLE = True
+except ImportError:
+    ORJSON_AVAILABLE = False
+
+
+TOKEN_FILE = Path(__file__).resolve().parent.parent / 'token.json'
+SCOPES = ['https://www.googleapis.com/auth/documents',
+          'https://www.googleapis.com/auth/drive']
+
+# Refresh OAuth tokens this long before they expire
+REFRESH_MARGIN = timedelta(minutes=5)
+
+_credentials = None
+# token.json's mtime when _credentials was loaded (None if it did not exist); a
+# change (e.g. the OAuth callback writing a new token) triggers a reload
+_token_mtime = None
+_lock = threading.Lock()
+
+# Refreshed tokens are written back to token.json off the calling thread
+_token_writer = ThreadPoolExecutor(max_workers=1)
+
+
+def _save_token(token_json):
+    """Persist a refreshed OAuth token."""
+    try:
+        TOKEN_FILE.write_text(token_json)
+    except OSError as e:
+        print(f"Warning: Could not save refreshed token: {e}", file=sys.stderr)
+
+
+def _needs_refresh(creds):
+    """Whether OAuth credentials are expired or about to expire."""
+    if not creds.refresh_token:
+        return False
+    if creds.expiry is None:
+        return not creds.valid
+    # google-auth stores expiry as a naive UTC datetime
+    now = datetime.now(timezone.utc).replace(tzinfo=None)
+    return creds.expiry - now < REFRESH_MARGIN
+
+
+def _token_file_mtime():
+    """Modification time of token.json, or None if it does not exist."""
+    try:
+        return TOKEN_FILE.stat().st_mtime_ns
+    except OSError:
+        return None
+
+
+def _load_credentials(use_oauth=True):
+    """Load credentials from OAuth2 token, service account, or API key."""
+    # Priority 1: OAuth2 credentials (for accessing user's own Drive)
+    if use_oauth and TOKEN_FILE.exists():
+        try:
+            # Load token without specifying scopes to avoid scope mismatch errors
+            # The token already contains the scopes it was created with
+            raw = TOKEN_FILE.read_bytes()
+            info = orjson.loads(raw) if ORJSON_AVAILABLE else json.loads(raw)
+            creds = Credentials.from_authorized_user_info(info)
+            if creds and (creds.valid or creds.refresh_token):
+                return creds
+        except Exception as e:
+            print(f"Error loading OAuth token: {e}", file=sys.stderr)
+    
+    # Priority 2: Service account
+    creds_path = os.getenv('GOOGLE_CREDENTIALS_PATH')
+    if creds_path and os.path.exists(creds_path):
+        return service_account.Credentials.from_service_account_file(creds_path, scopes=SCOPES)
+    
+    # Priority 3: API key (limited access)
+    api_key = os.getenv('GOOGLE_API_KEY')
+    if not api_key:
+        raise ValueError("No authentication method available. Please set up OAuth2, service account, or API key.")
+    
+    return api_key
+
+
+def get_credentials():
+    """
+    Get Google API credentials from OAuth2 token, service account, or API key.
+    
+    The same object is returned on every call until token.json changes; OAuth
+    tokens are refreshed only when they are within REFRESH_MARGIN of expiring.
+    If a refresh fails, the service account or API key is used for this call and
+    the token is loaded again on the next one.
+    
+    Returns:
+        google.auth credentials, or an API key string
+    """
+    global _credentials, _token_mtime
+    with _lock:
+        token_mtime = _token_file_mtime()
+        if _credentials is None or token_mtime != _token_mtime:
+            _credentials = _load_credentials()
+            _token_mtime = token_mtime
+        creds = _credentials
+        
+        if isinstance(creds, Credentials) and _needs_refresh(creds):
+            try:
+                creds.refresh(Request())
+                _token_writer.submit(_save_token, creds.to_json())
+            except Exception as e:
+                print(f"Error refreshing OAuth token: {e}", file=sys.stderr)
+                _credentials = None
+                return _load_credentials(use_oauth=False)
+    
+    return creds
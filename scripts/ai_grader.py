@@ -5,22 +5,120 @@ Takes document text and rubric, returns structured feedback with comments and sc
 import os
 import sys
 import json
+import time
+import hashlib
+import datetime
+import functools
+import random
+import threading
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
 import google.generativeai as genai
-from typing import Dict, List, Any
+from google.generativeai import caching
+from google.api_core import exceptions as google_exceptions
+from typing import Dict, List, Any, Optional, Tuple
+import grading_cache
+
+try:
+    import orjson
+    ORJSON_AVAILABLE = True
+except ImportError:
+    ORJSON_AVAILABLE = False
+
+
+# Gemini context caches for the static rubric/instructions prefix, keyed by
+# a hash of (model, prefix). None marks a prefix the API refused to cache.
+_CONTEXT_CACHES = {}
+# Per-key locks so concurrent callers create at most one cache per (model, prefix),
+# and the lock guarding that lock table
+_CONTEXT_CACHE_LOCKS = {}
+_CONTEXT_CACHE_LOCKS_LOCK = threading.Lock()
+CONTEXT_CACHE_TTL = datetime.timedelta(minutes=10)
+# Smallest prefix (in estimated tokens) that any Gemini model accepts for caching
+CONTEXT_CACHE_MIN_TOKENS = 1024
+
+# Resolved model names are persisted here so cold processes skip list_models
+MODEL_NAME_CACHE_FILE = Path.home() / '.cache' / 'grader' / 'model.json'
+MODEL_NAME_CACHE_TTL = 24 * 60 * 60
+# GenerativeModel objects shared across calls, keyed by resolved model name
+_MODEL_CACHE = {}
+_MODEL_CACHE_LOCK = threading.Lock()
+# API key genai is currently configured with, and its hash
+_CONFIGURED_KEY = None
+_CONFIGURED_KEY_HASH = None
+
+# Batched grading budgets: output cap per request, estimated output per graded
+# document, and the most document text (in estimated tokens) packed into one request
+BATCH_MAX_OUTPUT_TOKENS = 8192
+OUTPUT_TOKENS_PER_DOC = 1500
+BATCH_MAX_INPUT_TOKENS = 100000
+
+# Transient Gemini errors are retried with capped exponential backoff and full jitter
+RETRYABLE_ERRORS = (
+    google_exceptions.ResourceExhausted,
+    google_exceptions.ServiceUnavailable,
+    google_exceptions.DeadlineExceeded,
+    google_exceptions.InternalServerError,
+)
+GENERATE_MAX_ATTEMPTS = 5
+RETRY_BASE_DELAY = 1.0
+RETRY_MAX_DELAY = 30.0
+
+# Single-document output cap: a base for the overall feedback fields plus room for
+# each criterion's score and comment. Thinking models count reasoning tokens against
+# this cap too, so it is kept well above the bare size of the JSON answer.
+OUTPUT_TOKENS_BASE = 1500
+OUTPUT_TOKENS_PER_CRITERION = 150
+MAX_OUTPUT_TOKENS = 4000
+
+# Documents longer than this (in estimated tokens) are graded map-reduce style:
+# split on paragraph boundaries into overlapping chunks, assessed per chunk,
+# then graded as a whole from the per-chunk notes
+LONG_DOCUMENT_TOKENS = 30000
+DOCUMENT_CHUNK_TOKENS = 8000
+DOCUMENT_CHUNK_OVERLAP_TOKENS = 200
+
+# Gemini requests in flight at once when chunks or documents are fanned out. They run
+# on worker threads with the sync client: the async client's grpc channel is bound to
+# the event loop that created it, and models (with their clients) are shared process-wide.
+MAX_CONCURRENT_GENERATIONS = 8
+# Process-wide cap on in-flight requests: chunk and document pools may nest
+# (a long document graded inside _grade_individually), so pool sizes alone do not bound it
+_GENERATION_SLOTS = threading.BoundedSemaphore(MAX_CONCURRENT_GENERATIONS)
+
+
+def _json_loads(data) -> Any:
+    """Parse JSON from str or bytes, with orjson when installed."""
+    if ORJSON_AVAILABLE:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def _json_dumps(obj: Any, indent: bool = False) -> bytes:
+    """Serialize to UTF-8 JSON bytes, with orjson when installed."""
+    if ORJSON_AVAILABLE:
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2 if indent else 0)
+    return json.dumps(obj, indent=2 if indent else None, ensure_ascii=False).encode('utf-8')
 
 
 def load_rubric(rubric_path: str) -> Dict[str, Any]:
     """Load rubric from JSON file."""
-    with open(rubric_path, 'r', encoding='utf-8') as f:
-        return json.load(f)
+    return _json_loads(Path(rubric_path).read_bytes())
 
 
-def create_grading_prompt(document_text: str, rubric: Dict[str, Any], custom_instructions: str = None) -> str:
-    """Create a structured prompt for AI grading."""
-    criteria_text = ""
-    for i, criterion in enumerate(rubric['criteria'], 1):
-        criteria_text += f"{i}. {criterion['name']} ({criterion['max_points']} points)\n"
-        criteria_text += f"   Description: {criterion['description']}\n\n"
+@functools.lru_cache(maxsize=16)
+def _render_prompt_prefix(rubric_json: str, custom_instructions: str = None) -> str:
+    """
+    Render the document-independent part of the grading prompt.
+    
+    Memoized on the serialized rubric and instructions, so a batch run builds it once.
+    """
+    rubric = json.loads(rubric_json)
+    criteria_text = "".join(
+        f"{i}. {criterion['name']} ({criterion['max_points']} points)\n"
+        f"   Description: {criterion['description']}\n\n"
+        for i, criterion in enumerate(rubric['criteria'], 1)
+    )
     
     # Add custom instructions if provided
     instructions_section = ""
@@ -36,32 +134,11 @@ ADDITIONAL GRADING INSTRUCTIONS:
 RUBRIC:
 {rubric['name']} (Total: {rubric['total_points']} points)
 
-{criteria_text}{instructions_section}STUDENT'S DOCUMENT:
-{document_text}
-
-TASK:
+{criteria_text}{instructions_section}TASK:
 1. Evaluate the document against each rubric criterion
 2. Assess grammar and essay structure (overall organization, flow, paragraph structure) - provide general observations, not detailed line-by-line analysis
-3. Identify strengths, key issues, and suggestions for improvement
-4. Assign points for each criterion based on performance
-5. Return your evaluation in the following JSON format:
-
-{{
-  "strengths": "List 2-4 key strengths of the assignment. Write in first person addressing the student directly using simple, clear language (e.g., 'You did this well...', 'Your approach to...'). Be specific and reference what they did well. Include observations about grammar and essay structure if relevant. Use everyday words, not complicated terms.",
-  "key_issues": "List 2-4 main issues or weaknesses. Write in first person addressing the student directly using simple, clear language (e.g., 'You need to improve...', 'Your work would benefit from...'). Be specific about what needs improvement. Include general observations about grammar and essay structure issues if present (e.g., 'Your essay structure could be improved...', 'There are some grammar issues that affect clarity...'). Use plain, easy-to-understand language.",
-  "suggestions": "Provide 2-4 actionable suggestions for improvement. Write in first person addressing the student directly using simple, conversational language (e.g., 'Consider...', 'Try...', 'You should...'). Be constructive and specific. Include suggestions about grammar and essay structure if relevant (e.g., 'Consider revising your essay structure to...', 'Pay attention to grammar to improve clarity...'). Use everyday words that are easy to understand.",
-  "criterion_comments": {{
-    "Clarity and Organization": "Brief comment about this criterion, written in first person addressing the student directly using simple, clear language",
-    "Content Quality": "Brief comment about this criterion, written in first person addressing the student directly using simple, clear language",
-    ...
-  }},
-  "scores": {{
-    "Clarity and Organization": 18,
-    "Content Quality": 25,
-    ...
-  }},
-  "total_score": 85
-}}
+3. Identify 2-4 strengths, 2-4 key issues, and 2-4 actionable suggestions for improvement
+4. Assign points for each criterion based on performance, with a brief comment (1-2 sentences) explaining each score
 
 IMPORTANT:
 - Write ALL feedback in FIRST PERSON, addressing the student directly as "you" (not "the student" or "this assignment")
@@ -73,28 +150,148 @@ IMPORTANT:
 - Strengths should highlight what the student did well using "you" language, including grammar and structure if relevant
 - Key Issues should identify the main problems that need addressing using "you" language, including general grammar and structure observations if present
 - Suggestions should be actionable and specific, written as direct advice to the student, including grammar and structure suggestions if relevant
-- For "criterion_comments", provide a brief comment (1-2 sentences) for each criterion explaining the score, written in first person using simple language
 - Scores should reflect actual performance, not just be high
 - Total score should match sum of individual criterion scores
-- Return ONLY valid JSON, no additional text
 
-Return the JSON now:"""
+"""
     
     return prompt
 
 
-def grade_with_ai(document_text: str, rubric: Dict[str, Any], model_name: str = "gemini-1.5-flash", custom_instructions: str = None) -> Dict[str, Any]:
+def create_grading_prompt(document_text: str, rubric: Dict[str, Any], custom_instructions: str = None) -> Tuple[str, str]:
     """
-    Grade document using Gemini API.
+    Create a structured prompt for AI grading.
     
-    Args:
-        document_text: Text content of the document
-        rubric: Rubric dictionary
-        model_name: Gemini model to use (will be auto-selected if not available)
-        custom_instructions: Optional custom instructions for grading
+    Returns:
+        (cached_prefix, per_doc_suffix): the prefix holds everything that is
+        identical for every document graded against this rubric, so it can be
+        stored in a Gemini context cache; the suffix holds the student document.
+    """
+    prompt = _render_prompt_prefix(json.dumps(rubric, sort_keys=True), custom_instructions)
+    
+    document_section = f"""STUDENT'S DOCUMENT:
+{document_text}"""
+    
+    return prompt, document_section
+
+
+def _get_context_cache(model_name: str, cached_prefix: str) -> Optional[caching.CachedContent]:
+    """
+    Look up or create a Gemini context cache holding the static prompt prefix.
+    
+    Returns None when the prefix is too small to cache or cache creation fails,
+    in which case the caller should send the full prompt instead.
+    """
+    if len(cached_prefix) // 4 < CONTEXT_CACHE_MIN_TOKENS:
+        return None
+    
+    key = hashlib.sha256(f"{model_name}\0{cached_prefix}".encode('utf-8')).hexdigest()
+    with _CONTEXT_CACHE_LOCKS_LOCK:
+        key_lock = _CONTEXT_CACHE_LOCKS.setdefault(key, threading.Lock())
+    
+    with key_lock:
+        if key in _CONTEXT_CACHES:
+            cache = _CONTEXT_CACHES[key]
+            if cache is None:
+                return None
+            # Reuse the cache unless it is about to expire
+            now = datetime.datetime.now(datetime.timezone.utc)
+            if cache.expire_time > now + datetime.timedelta(seconds=30):
+                return cache
+        
+        try:
+            cache = caching.CachedContent.create(
+                model=model_name,
+                display_name=f"grader-{key[:16]}",
+                contents=[cached_prefix],
+                ttl=CONTEXT_CACHE_TTL
+            )
+        except Exception as e:
+            print(f"Warning: Could not create context cache, sending full prompt: {e}", file=sys.stderr)
+            cache = None
+        
+        _CONTEXT_CACHES[key] = cache
+        return cache
+
+
+def build_response_schema(rubric: Dict[str, Any], batch: bool = False) -> "genai.protos.Schema":
+    """
+    Build the Gemini response schema for a grading result against this rubric.
+    
+    With batch=True the schema is {"results": [{"doc_id": ..., <grading fields>}, ...]}
+    for grading several documents in one request.
+    """
+    Schema = genai.protos.Schema
+    Type = genai.protos.Type
+    criterion_names = [c['name'] for c in rubric['criteria']]
+    
+    properties = {
+        'strengths': Schema(type=Type.STRING),
+        'key_issues': Schema(type=Type.STRING),
+        'suggestions': Schema(type=Type.STRING),
+        'criterion_comments': Schema(
+            type=Type.OBJECT,
+            properties={name: Schema(type=Type.STRING) for name in criterion_names},
+            required=criterion_names
+        ),
+        'scores': Schema(
+            type=Type.OBJECT,
+            properties={name: Schema(type=Type.NUMBER) for name in criterion_names},
+            required=criterion_names
+        ),
+        'total_score': Schema(type=Type.NUMBER),
+    }
+    required = ['strengths', 'key_issues', 'suggestions', 'criterion_comments', 'scores', 'total_score']
+    
+    if not batch:
+        return Schema(type=Type.OBJECT, properties=properties, required=required)
+    
+    result_schema = Schema(
+        type=Type.OBJECT,
+        properties={'doc_id': Schema(type=Type.STRING), **properties},
+        required=['doc_id'] + required
+    )
+    return Schema(
+        type=Type.OBJECT,
+        properties={'results': Schema(type=Type.ARRAY, items=result_schema)},
+        required=['results']
+    )
+
+
+def build_chunk_schema(rubric: Dict[str, Any]) -> "genai.protos.Schema":
+    """
+    Build the response schema for assessing one excerpt of a long document:
+    {"criteria": {<criterion name>: {"score": ..., "evidence": ...}}}
+    """
+    Schema = genai.protos.Schema
+    Type = genai.protos.Type
+    criterion_names = [c['name'] for c in rubric['criteria']]
+    
+    criterion_schema = Schema(
+        type=Type.OBJECT,
+        properties={'score': Schema(type=Type.NUMBER), 'evidence': Schema(type=Type.STRING)},
+        required=['score', 'evidence']
+    )
+    return Schema(
+        type=Type.OBJECT,
+        properties={
+            'criteria': Schema(
+                type=Type.OBJECT,
+                properties={name: criterion_schema for name in criterion_names},
+                required=criterion_names
+            )
+        },
+        required=['criteria']
+    )
+
+
+def _configure_api() -> str:
+    """
+    Configure the Gemini SDK with the API key from the environment.
+    genai.configure is only called again when the key changes.
     
     Returns:
-        Dictionary with comments, scores, and feedback
+        str: Short hash of the API key, used to partition per-key caches
     """
     api_key = os.getenv('GEMINI_API_KEY')
     if not api_key:
@@ -103,138 +300,342 @@ def grade_with_ai(document_text: str, rubric: Dict[str, Any], model_name: str =
     # Strip any whitespace that might have been accidentally included
     api_key = api_key.strip()
     
-    genai.configure(api_key=api_key)
+    global _CONFIGURED_KEY, _CONFIGURED_KEY_HASH
+    if api_key != _CONFIGURED_KEY:
+        genai.configure(api_key=api_key)
+        _CONFIGURED_KEY = api_key
+        _CONFIGURED_KEY_HASH = hashlib.sha256(api_key.encode('utf-8')).hexdigest()[:16]
+    return _CONFIGURED_KEY_HASH
+
+
+def _read_model_name_cache() -> Dict[str, Any]:
+    """Read persisted model resolutions ({cache_key: {'name': ..., 'resolved_at': ...}})."""
+    try:
+        return _json_loads(MODEL_NAME_CACHE_FILE.read_bytes())
+    except (OSError, ValueError):
+        return {}
+
+
+def _write_model_name_cache(entries: Dict[str, Any]):
+    """Persist model resolutions; failures only cost a list_models call next time."""
+    try:
+        MODEL_NAME_CACHE_FILE.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = MODEL_NAME_CACHE_FILE.with_suffix('.tmp')
+        tmp_path.write_bytes(_json_dumps(entries))
+        os.replace(tmp_path, MODEL_NAME_CACHE_FILE)
+    except OSError as e:
+        print(f"Warning: Could not save model cache: {e}", file=sys.stderr)
+
+
+@functools.lru_cache(maxsize=8)
+def _resolve_model_name(model_name: str, api_key_hash: str) -> str:
+    """
+    Pick an available model that supports generateContent, preferring the fastest.
     
-    # Configure model
-    generation_config = {
-        "temperature": 0.3,
-        "top_p": 0.95,
-        "top_k": 40,
-        "max_output_tokens": 4000,
-    }
+    Resolutions are memoized per process and persisted to MODEL_NAME_CACHE_FILE for
+    MODEL_NAME_CACHE_TTL seconds, so list_models is not called on every grade.
+    Raises if the model list cannot be fetched (failures are not cached).
+    """
+    cache_key = f"{model_name}|{api_key_hash}"
+    entry = _read_model_name_cache().get(cache_key)
+    if entry and time.time() - entry.get('resolved_at', 0) < MODEL_NAME_CACHE_TTL:
+        return entry['name']
+    
+    # List all available models
+    available_models = []
+    for m in genai.list_models():
+        if 'generateContent' in m.supported_generation_methods:
+            available_models.append(m.name)
+    
+    # Try to find a working model
+    # Priority order: gemini-2.5-flash (fastest), gemini-pro-latest, gemini-2.5-pro, or any available
+    preferred_models = [
+        "models/gemini-2.5-flash",  # Latest fast model
+        "models/gemini-flash-latest",  # Latest flash
+        "models/gemini-pro-latest",  # Latest pro
+        "models/gemini-2.5-pro",  # Latest pro version
+        "models/gemini-2.0-flash",  # Alternative flash
+        model_name,  # Try the requested model
+    ]
+    
+    model_name_to_use = None
+    for preferred in preferred_models:
+        # Check if this model is in the available list
+        if preferred in available_models:
+            model_name_to_use = preferred
+            break
+    
+    # If no preferred model found, use the first available one
+    if not model_name_to_use and available_models:
+        model_name_to_use = available_models[0]
+    
+    if not model_name_to_use:
+        raise ValueError(f"No models with generateContent support found. Available models: {[m.name for m in genai.list_models()]}")
+    
+    entries = _read_model_name_cache()
+    entries[cache_key] = {'name': model_name_to_use, 'resolved_at': time.time()}
+    _write_model_name_cache(entries)
+    
+    return model_name_to_use
+
+
+def _get_model(model_name: str) -> Tuple[genai.GenerativeModel, str]:
+    """
+    Get a (shared) Gemini model, auto-selecting an available one that supports generateContent.
+    Generation config is passed per request, so one model object serves every rubric.
+    
+    Returns:
+        (model, model_name_to_use)
+    """
+    api_key_hash = _configure_api()
     
     # Ensure model name has models/ prefix if not already present
     if not model_name.startswith('models/'):
         model_name = f"models/{model_name}"
     
-    # Try to find an available model that supports generateContent
-    model = None
-    model_name_to_use = None
-    
     try:
-        # List all available models
-        available_models = []
-        for m in genai.list_models():
-            if 'generateContent' in m.supported_generation_methods:
-                available_models.append(m.name)
-        
-        # Try to find a working model
-        # Priority order: gemini-2.5-flash (fastest), gemini-pro-latest, gemini-2.5-pro, or any available
-        preferred_models = [
-            "models/gemini-2.5-flash",  # Latest fast model
-            "models/gemini-flash-latest",  # Latest flash
-            "models/gemini-pro-latest",  # Latest pro
-            "models/gemini-2.5-pro",  # Latest pro version
-            "models/gemini-2.0-flash",  # Alternative flash
-            model_name,  # Try the requested model
-        ]
-        
-        for preferred in preferred_models:
-            # Check if this model is in the available list
-            if preferred in available_models:
-                model_name_to_use = preferred
-                break
-        
-        # If no preferred model found, use the first available one
-        if not model_name_to_use and available_models:
-            model_name_to_use = available_models[0]
-        
-        if not model_name_to_use:
-            raise ValueError(f"No models with generateContent support found. Available models: {[m.name for m in genai.list_models()]}")
-        
-        # Initialize the model
-        model = genai.GenerativeModel(model_name=model_name_to_use, generation_config=generation_config)
-        
+        model_name_to_use = _resolve_model_name(model_name, api_key_hash)
     except Exception as e:
-        # If listing models fails, try common model names as fallback
-        fallback_models = ["models/gemini-2.5-flash", "models/gemini-pro-latest", "models/gemini-flash-latest", model_name]
-        for fallback_name in fallback_models:
-            try:
-                model = genai.GenerativeModel(model_name=fallback_name, generation_config=generation_config)
-                model_name_to_use = fallback_name
-                break
-            except:
-                continue
-        else:
-            raise ValueError(f"Could not initialize any Gemini model. Tried to list models but got: {str(e)}. Fallback models also failed.")
+        # If listing models fails, fall back to a common model name
+        print(f"Warning: Could not list Gemini models ({e}), falling back to models/gemini-2.5-flash", file=sys.stderr)
+        model_name_to_use = "models/gemini-2.5-flash"
     
-    # Create prompt
-    prompt = create_grading_prompt(document_text, rubric, custom_instructions)
+    with _MODEL_CACHE_LOCK:
+        model = _MODEL_CACHE.get(model_name_to_use)
+        if model is None:
+            model = genai.GenerativeModel(model_name=model_name_to_use)
+            _MODEL_CACHE[model_name_to_use] = model
     
-    try:
-        # Generate response
-        response = model.generate_content(prompt)
-        
-        # Extract JSON from response
-        response_text = response.text.strip()
-        
-        # Try to extract JSON if wrapped in markdown code blocks
-        if "```json" in response_text:
-            response_text = response_text.split("```json")[1].split("```")[0].strip()
-        elif "```" in response_text:
-            response_text = response_text.split("```")[1].split("```")[0].strip()
-        
-        # Find the first { and last } to extract just the JSON object
-        first_brace = response_text.find("{")
-        last_brace = response_text.rfind("}")
-        
-        if first_brace != -1 and last_brace != -1 and last_brace > first_brace:
-            response_text = response_text[first_brace:last_brace + 1]
-        
-        # Parse JSON with better error handling
-        result = None
-        json_errors = []
-        
+    return model, model_name_to_use
+
+
+def _invalidate_model(model_name_to_use: str):
+    """Forget a resolved model (e.g. after a 404) so the next call re-resolves it."""
+    _resolve_model_name.cache_clear()
+    with _MODEL_CACHE_LOCK:
+        _MODEL_CACHE.pop(model_name_to_use, None)
+    entries = _read_model_name_cache()
+    stale_keys = [key for key, entry in entries.items() if entry.get('name') == model_name_to_use]
+    if stale_keys:
+        for key in stale_keys:
+            del entries[key]
+        _write_model_name_cache(entries)
+
+
+def _get_cached_result(key: str, rubric: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """Return a previously stored result for key (re-validated against the rubric), or None."""
+    result = grading_cache.get_result(key)
+    if result is None:
+        return None
+    return validate_grading_result(result, rubric)
+
+
+def _max_output_tokens(rubric: Dict[str, Any]) -> int:
+    """Size the output cap for one graded document from the number of rubric criteria."""
+    return min(MAX_OUTPUT_TOKENS, OUTPUT_TOKENS_BASE + OUTPUT_TOKENS_PER_CRITERION * len(rubric['criteria']))
+
+
+def _generation_config(rubric: Dict[str, Any], batch: bool = False) -> Dict[str, Any]:
+    """Generation config with native JSON mode constrained to the rubric's schema."""
+    return {
+        "temperature": 0.3,
+        "top_p": 0.95,
+        "top_k": 40,
+        "max_output_tokens": BATCH_MAX_OUTPUT_TOKENS if batch else _max_output_tokens(rubric),
+        "response_mime_type": "application/json",
+        "response_schema": build_response_schema(rubric, batch=batch),
+    }
+
+
+def _warn_if_truncated(chunk):
+    """Report responses that stopped at max_output_tokens, with their token usage."""
+    if chunk is None or not chunk.candidates:
+        return
+    if chunk.candidates[0].finish_reason == genai.protos.Candidate.FinishReason.MAX_TOKENS:
+        usage = chunk.usage_metadata
+        print(f"Warning: Response hit max_output_tokens after {usage.candidates_token_count} output tokens "
+              f"(prompt: {usage.prompt_token_count}); it is likely truncated", file=sys.stderr)
+
+
+def _collect_stream(response) -> str:
+    """
+    Accumulate text from a streamed response as chunks arrive.
+    Chunks without text parts (e.g. the final usage-only chunk) are skipped.
+    """
+    parts = []
+    chunk = None
+    for chunk in response:
+        if chunk.parts:
+            parts.append(chunk.text)
+    _warn_if_truncated(chunk)
+    return "".join(parts)
+
+
+def _retry_delay(failures: int) -> float:
+    """Full-jitter exponential backoff delay before the next attempt."""
+    return random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** failures))
+
+
+def _generate(model_name: str, generation_config: Dict[str, Any], cached_prefix: str, document_section: str) -> str:
+    """
+    Run generation, reusing the cached prompt prefix when available. The response is
+    streamed and its text accumulated as chunks arrive. Returns the response text.
+    If the resolved model has disappeared (404), re-resolve it and retry once; transient
+    errors (RETRYABLE_ERRORS) are retried up to GENERATE_MAX_ATTEMPTS times with backoff.
+    At most MAX_CONCURRENT_GENERATIONS requests are in flight across all threads.
+    """
+    failures = 0
+    model_refreshed = False
+    while True:
+        model, model_name_to_use = _get_model(model_name)
         try:
-            result = json.loads(response_text)
-        except json.JSONDecodeError as e:
-            json_errors.append(f"Initial parse failed: {str(e)}")
-            
-            # Try to fix common JSON issues
-            try:
-                # Fix single quotes
-                fixed_text = response_text.replace("'", '"')
-                # Fix trailing commas
-                import re
-                fixed_text = re.sub(r',\s*}', '}', fixed_text)
-                fixed_text = re.sub(r',\s*]', ']', fixed_text)
-                # Fix unquoted keys
-                fixed_text = re.sub(r'(\w+):', r'"\1":', fixed_text)
-                result = json.loads(fixed_text)
-            except json.JSONDecodeError as e2:
-                json_errors.append(f"Fixed parse failed: {str(e2)}")
-                
-                # Last resort: try to extract just the essential parts
-                try:
-                    # Try to find and parse just the scores and comments
-                    scores_match = re.search(r'"scores"\s*:\s*\{[^}]+\}', response_text, re.DOTALL)
-                    comments_match = re.search(r'"comments"\s*:\s*\[[^\]]+\]', response_text, re.DOTALL)
-                    
-                    if scores_match or comments_match:
-                        # Build a minimal valid JSON
-                        minimal_json = '{"comments": [], "scores": {}, "total_score": 0, "summary": ""}'
-                        result = json.loads(minimal_json)
-                        print(f"Warning: Using fallback JSON due to parsing errors: {json_errors}", file=sys.stderr)
-                    else:
-                        raise ValueError(f"Could not parse JSON response. Errors: {json_errors}. Response (first 500 chars): {response_text[:500]}")
-                except Exception as e3:
-                    raise ValueError(f"Could not parse JSON response. Errors: {json_errors}. Response (first 500 chars): {response_text[:500]}")
-        
-        if result is None:
-            raise ValueError(f"Could not parse JSON response. Response (first 500 chars): {response_text[:500]}")
+            cache = _get_context_cache(model_name_to_use, cached_prefix)
+            with _GENERATION_SLOTS:
+                if cache is not None:
+                    cached_model = genai.GenerativeModel.from_cached_content(cached_content=cache)
+                    response = cached_model.generate_content(document_section, generation_config=generation_config, stream=True)
+                else:
+                    response = model.generate_content(cached_prefix + document_section, generation_config=generation_config, stream=True)
+                return _collect_stream(response)
+        except google_exceptions.NotFound:
+            if model_refreshed:
+                raise
+            model_refreshed = True
+            print(f"Warning: Model {model_name_to_use} not found, re-resolving", file=sys.stderr)
+            _invalidate_model(model_name_to_use)
+        except RETRYABLE_ERRORS as e:
+            failures += 1
+            if failures >= GENERATE_MAX_ATTEMPTS:
+                raise
+            delay = _retry_delay(failures)
+            print(f"Warning: Gemini request failed ({e}), retrying in {delay:.1f}s", file=sys.stderr)
+            time.sleep(delay)
+
+
+def _parse_response(response_text: str) -> Dict[str, Any]:
+    """Parse the model's JSON response."""
+    # Structured output guarantees a JSON object matching the schema
+    try:
+        return _json_loads(response_text)
+    except ValueError as e:  # json and orjson decode errors both subclass ValueError
+        raise ValueError(f"Could not parse JSON response: {e}. Response (first 500 chars): {response_text[:500]}")
+
+
+def _split_document(document_text: str) -> List[str]:
+    """
+    Split a long document into chunks of about DOCUMENT_CHUNK_TOKENS on paragraph
+    boundaries, repeating up to DOCUMENT_CHUNK_OVERLAP_TOKENS of trailing paragraphs
+    at the start of the next chunk.
+    """
+    chunk_chars = DOCUMENT_CHUNK_TOKENS * 4
+    overlap_chars = DOCUMENT_CHUNK_OVERLAP_TOKENS * 4
+    
+    paragraphs = []
+    for paragraph in document_text.split('\n'):
+        # Hard-split paragraphs that would not fit in a chunk on their own
+        paragraphs.extend(paragraph[i:i + chunk_chars] for i in range(0, max(len(paragraph), 1), chunk_chars))
+    
+    chunks = []
+    current = []
+    current_chars = 0
+    for paragraph in paragraphs:
+        if current and current_chars + len(paragraph) + 1 > chunk_chars:
+            chunks.append('\n'.join(current))
+            overlap = []
+            overlap_len = 0
+            for previous in reversed(current):
+                if overlap_len + len(previous) + 1 > overlap_chars:
+                    break
+                overlap.append(previous)
+                overlap_len += len(previous) + 1
+            current = overlap[::-1]
+            current_chars = overlap_len
+        current.append(paragraph)
+        current_chars += len(paragraph) + 1
+    
+    if current:
+        chunks.append('\n'.join(current))
+    
+    return chunks
+
+
+def _grade_long_document(document_text: str, rubric: Dict[str, Any], model_name: str, custom_instructions: str = None) -> Dict[str, Any]:
+    """
+    Grade a document too long for one prompt: assess the chunks concurrently against
+    the rubric, then grade the whole document from the per-chunk notes.
+    
+    Returns:
+        Unvalidated grading result
+    """
+    chunks = _split_document(document_text)
+    cached_prefix, _ = create_grading_prompt("", rubric, custom_instructions)
+    generation_config = _generation_config(rubric)
+    chunk_config = dict(generation_config, response_schema=build_chunk_schema(rubric))
+    
+    def assess_chunk(k: int, chunk: str) -> Dict[str, Any]:
+        section = (f"The student's document is too long to grade in one pass, so it has been split into {len(chunks)} "
+                   f"overlapping excerpts. This is excerpt {k} of {len(chunks)}. Do not write feedback yet: for each "
+                   f"rubric criterion, give a provisional score based on this excerpt alone and briefly note the "
+                   f"evidence for it.\n\nEXCERPT {k} OF {len(chunks)}:\n{chunk}")
+        response_text = _generate(model_name, chunk_config, cached_prefix, section)
+        return _parse_response(response_text).get('criteria', {})
+    
+    with ThreadPoolExecutor(max_workers=min(len(chunks), MAX_CONCURRENT_GENERATIONS)) as executor:
+        notes = list(executor.map(assess_chunk, range(1, len(chunks) + 1), chunks))
+    
+    notes_text = "".join(f"EXCERPT {k}:\n{json.dumps(excerpt_notes, indent=2)}\n\n" for k, excerpt_notes in enumerate(notes, 1))
+    section = (f"The student's document was too long to grade in one pass. It was split into {len(chunks)} overlapping "
+               f"excerpts and each excerpt was assessed against the rubric. Using the per-excerpt notes below, grade the "
+               f"document as a whole: scores should reflect the complete document, not the sum of excerpt scores.\n\n"
+               f"EXCERPT NOTES:\n{notes_text}")
+    response_text = _generate(model_name, generation_config, cached_prefix, section)
+    return _parse_response(response_text)
+
+
+def grade_with_ai(document_text: str, rubric: Dict[str, Any], model_name: str = "gemini-1.5-flash", custom_instructions: str = None,
+                  force_refresh: bool = False, use_cache: bool = True) -> Dict[str, Any]:
+    """
+    Grade document using Gemini API.
+    
+    Results are cached (see grading_cache), keyed by document text, rubric, resolved
+    model and instructions, so regrading an unchanged document does not call Gemini again.
+    Documents over LONG_DOCUMENT_TOKENS are graded in chunks (see _grade_long_document).
+    
+    Args:
+        document_text: Text content of the document
+        rubric: Rubric dictionary
+        model_name: Gemini model to use (will be auto-selected if not available)
+        custom_instructions: Optional custom instructions for grading
+        force_refresh: Skip the cache lookup and grade again (the new result is still stored)
+        use_cache: If False, neither read nor write the result cache
+    
+    Returns:
+        Dictionary with comments, scores, and feedback
+    """
+    # Key on the model that actually grades, not the configured alias it resolves from
+    _, model_name_to_use = _get_model(model_name)
+    cache_key = grading_cache.make_key(document_text, rubric, model_name_to_use, custom_instructions)
+    if use_cache and not force_refresh:
+        cached_result = _get_cached_result(cache_key, rubric)
+        if cached_result is not None:
+            return cached_result
+    
+    generation_config = _generation_config(rubric)
+    
+    # Create prompt - static rubric prefix first, student document last
+    cached_prefix, document_section = create_grading_prompt(document_text, rubric, custom_instructions)
+    
+    try:
+        if len(document_text) // 4 > LONG_DOCUMENT_TOKENS:
+            result = _grade_long_document(document_text, rubric, model_name, custom_instructions)
+        else:
+            response_text = _generate(model_name, generation_config, cached_prefix, document_section)
+            result = _parse_response(response_text)
         
         # Validate and normalize result
         validated_result = validate_grading_result(result, rubric)
+        if use_cache:
+            grading_cache.set_result(cache_key, validated_result)
         
         return validated_result
     
@@ -243,6 +644,132 @@ def grade_with_ai(document_text: str, rubric: Dict[str, Any], model_name: str =
         raise
 
 
+def _plan_batches(documents: List[Tuple[str, str]]) -> Tuple[List[List[Tuple[str, str]]], List[Tuple[str, str]]]:
+    """
+    Split documents into batches that fit the batch input/output token budgets.
+    
+    Returns:
+        (batches, singles): singles are long documents, graded in chunks on their own
+    """
+    batches = []
+    singles = []
+    current = []
+    current_tokens = 0
+    docs_per_batch = max(1, BATCH_MAX_OUTPUT_TOKENS // OUTPUT_TOKENS_PER_DOC)
+    
+    for doc_id, document_text in documents:
+        doc_tokens = len(document_text) // 4
+        if doc_tokens > LONG_DOCUMENT_TOKENS:
+            singles.append((doc_id, document_text))
+            continue
+        if current and (len(current) >= docs_per_batch or current_tokens + doc_tokens > BATCH_MAX_INPUT_TOKENS):
+            batches.append(current)
+            current = []
+            current_tokens = 0
+        current.append((doc_id, document_text))
+        current_tokens += doc_tokens
+    
+    if current:
+        batches.append(current)
+    
+    return batches, singles
+
+
+def _create_batch_document_section(documents: List[Tuple[str, str]]) -> str:
+    """Render the per-request suffix holding several numbered student documents."""
+    parts = [f"You will grade the following {len(documents)} student documents. Grade each document independently "
+             f"against the rubric and return one result per document, echoing its doc_id exactly.\n\n"]
+    for k, (doc_id, document_text) in enumerate(documents, 1):
+        parts.append(f"STUDENT DOCUMENT #{k} (doc_id: {doc_id}):\n{document_text}\n\n")
+    return "".join(parts)
+
+
+def grade_batch_with_ai(documents: List[Tuple[str, str]], rubric: Dict[str, Any], model_name: str = "gemini-1.5-flash", custom_instructions: str = None,
+                        force_refresh: bool = False, use_cache: bool = True) -> Dict[str, Any]:
+    """
+    Grade several documents against the same rubric, packing them into as few Gemini requests as possible.
+    
+    Documents with a cached result are not sent to Gemini. Documents that do not fit
+    in a batch, or that a batch response omits, are graded individually and concurrently.
+    
+    Args:
+        documents: List of (doc_id, document_text) tuples
+        rubric: Rubric dictionary
+        model_name: Gemini model to use (will be auto-selected if not available)
+        custom_instructions: Optional custom instructions for grading
+        force_refresh: Skip cache lookups and grade every document again (new results are still stored)
+        use_cache: If False, neither read nor write the result cache
+    
+    Returns:
+        Dictionary mapping doc_id to its grading result, or to the Exception raised while grading it
+    """
+    batch_config = _generation_config(rubric, batch=True)
+    cached_prefix, _ = create_grading_prompt("", rubric, custom_instructions)
+    
+    _, model_name_to_use = _get_model(model_name)
+    
+    results = {}
+    cache_keys = {}
+    uncached = []
+    for doc_id, document_text in documents:
+        cache_keys[doc_id] = grading_cache.make_key(document_text, rubric, model_name_to_use, custom_instructions)
+        cached_result = _get_cached_result(cache_keys[doc_id], rubric) if use_cache and not force_refresh else None
+        if cached_result is not None:
+            results[doc_id] = cached_result
+        else:
+            uncached.append((doc_id, document_text))
+    
+    batches, pending = _plan_batches(uncached)
+    
+    for batch in batches:
+        if len(batch) == 1:
+            pending.extend(batch)
+            continue
+        try:
+            response_text = _generate(model_name, batch_config, cached_prefix, _create_batch_document_section(batch))
+            batch_results = _parse_response(response_text).get('results', [])
+        except Exception as e:
+            print(f"Warning: Batch grading failed, grading documents individually: {e}", file=sys.stderr)
+            batch_results = []
+        
+        batch_doc_ids = {doc_id for doc_id, _ in batch}
+        for result in batch_results:
+            doc_id = result.pop('doc_id', None)
+            if doc_id in batch_doc_ids and doc_id not in results:
+                results[doc_id] = validate_grading_result(result, rubric)
+                if use_cache:
+                    grading_cache.set_result(cache_keys[doc_id], results[doc_id])
+        pending.extend(doc for doc in batch if doc[0] not in results)
+    
+    if pending:
+        # Cache lookups were already done above; only store the new results
+        results.update(_grade_individually(pending, rubric, model_name, custom_instructions, use_cache))
+    
+    return results
+
+
+def _grade_individually(documents: List[Tuple[str, str]], rubric: Dict[str, Any], model_name: str, custom_instructions: str = None,
+                        use_cache: bool = True) -> Dict[str, Any]:
+    """Grade documents one per request, up to MAX_CONCURRENT_GENERATIONS at a time (results are not looked up in the cache)."""
+    def grade(document_text: str):
+        try:
+            return grade_with_ai(document_text, rubric, model_name, custom_instructions, force_refresh=True, use_cache=use_cache)
+        except Exception as e:
+            return e
+    
+    with ThreadPoolExecutor(max_workers=min(len(documents), MAX_CONCURRENT_GENERATIONS)) as executor:
+        outcomes = list(executor.map(grade, (text for _, text in documents)))
+    return {doc_id: outcome for (doc_id, _), outcome in zip(documents, outcomes)}
+
+
+def _safe_float(value: Any) -> float:
+    """Convert a model-supplied score to float, treating non-numeric values as 0."""
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return 0.0
+
+
 def validate_grading_result(result: Dict[str, Any], rubric: Dict[str, Any]) -> Dict[str, Any]:
     """Validate and normalize grading result."""
     # Ensure all required fields exist
@@ -259,27 +786,15 @@ def validate_grading_result(result: Dict[str, Any], rubric: Dict[str, Any]) -> D
     if 'total_score' not in result:
         result['total_score'] = 0
     
-    # Validate scores match rubric criteria
-    criterion_names = [c['name'] for c in rubric['criteria']]
-    validated_scores = {}
-    total = 0
-    
-    for criterion in rubric['criteria']:
-        name = criterion['name']
-        max_points = criterion['max_points']
-        
-        if name in result['scores']:
-            score = result['scores'][name]
-            # Ensure score is within valid range
-            score = max(0, min(max_points, float(score)))
-        else:
-            score = 0
-        
-        validated_scores[name] = score
-        total += score
+    # Validate scores match rubric criteria, clamped to [0, max_points]
+    scores = result['scores']
+    validated_scores = {
+        criterion['name']: max(0.0, min(float(criterion['max_points']), _safe_float(scores.get(criterion['name'], 0))))
+        for criterion in rubric['criteria']
+    }
     
     result['scores'] = validated_scores
-    result['total_score'] = total
+    result['total_score'] = sum(validated_scores.values())
     
     # Ensure criterion_comments exist for all criteria
     validated_comments = {}
@@ -324,7 +839,7 @@ def main():
         result = grade_with_ai(document_text, rubric)
         
         # Output JSON result
-        print(json.dumps(result, indent=2))
+        sys.stdout.buffer.write(_json_dumps(result, indent=True) + b"\n")
         return result
     
     except Exception as e:
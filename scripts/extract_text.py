@@ -3,55 +3,134 @@ Extract text content from Google Docs using Google Docs API.
 """
 import os
 import sys
-from google.oauth2.credentials import Credentials
-from google.oauth2 import service_account
-from googleapiclient.discovery import build
-from googleapiclient.errors import HttpError
+from collections import deque
+import functools
+import threading
+import requests
+import google.auth
+from google.auth.transport.requests import Request as AuthRequest
 import json
+try:
+    import orjson
+    ORJSON_AVAILABLE = True
+except ImportError:
+    ORJSON_AVAILABLE = False
 
 
-def get_credentials():
-    """Get Google API credentials from OAuth2 token, service account, or API key."""
-    from pathlib import Path
-    from google.oauth2.credentials import Credentials
-    from google.auth.transport.requests import Request
-    
-    project_root = Path(__file__).parent.parent
-    
-    # Priority 1: OAuth2 credentials (for accessing user's own Drive)
-    token_file = project_root / 'token.json'
-    if token_file.exists():
-        try:
-            # Load token without specifying scopes to avoid scope mismatch errors
-            # The token already contains the scopes it was created with
-            creds = Credentials.from_authorized_user_file(str(token_file))
-            if creds and creds.valid:
-                return creds
-            # If expired, try to refresh
-            if creds and creds.expired and creds.refresh_token:
-                creds.refresh(Request())
-                # Save refreshed token
-                with open(token_file, 'w') as token:
-                    token.write(creds.to_json())
-                return creds
-        except Exception as e:
-            print(f"Error loading OAuth token: {e}", file=sys.stderr)
+# Add scripts directory to path for imports
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from _google_auth import get_credentials
+
+
+# Partial-response mask for documents().get(): only the text-bearing parts
+# of the body, skipping styles, lists, inline objects, suggestions, etc.
+_PARAGRAPH_TEXT_FIELDS = 'paragraph/elements/textRun/content'
+
+# Tables nested inside table cells are masked down to their text up to this depth;
+# deeper tables are requested whole, so no text is dropped at any depth
+MASKED_TABLE_DEPTH = 3
+
+
+def _content_fields(depth):
+    """Fields mask for a list of structural elements, following tables into their cells."""
+    if depth == 0:
+        table_fields = 'table'
+    else:
+        table_fields = f'table/tableRows/tableCells/content({_content_fields(depth - 1)})'
+    return (
+        f'{_PARAGRAPH_TEXT_FIELDS},'
+        f'{table_fields},'
+        f'tableOfContents/content({_PARAGRAPH_TEXT_FIELDS})'
+    )
+
+
+DOC_TEXT_FIELDS = f'body/content({_content_fields(MASKED_TABLE_DEPTH)})'
+
+# documents.get is called directly over REST rather than through a discovery-built
+# googleapiclient service, which fetches and parses the discovery document per build()
+DOCS_GET_URL = 'https://docs.googleapis.com/v1/documents/{doc_id}'
+DOCS_READONLY_SCOPES = ['https://www.googleapis.com/auth/documents.readonly']
+
+# One pooled HTTP session per thread: extractions run concurrently in worker
+# threads (see grading_workflow), and requests.Session is not thread-safe
+_thread_local = threading.local()
+
+
+def _get_session():
+    """Return this thread's pooled HTTP session."""
+    session = getattr(_thread_local, 'session', None)
+    if session is None:
+        session = _thread_local.session = requests.Session()
+    return session
+
+
+@functools.lru_cache(maxsize=1)
+def _default_credentials():
+    """Application default credentials, used when no credentials are passed."""
+    credentials, _ = google.auth.default(scopes=DOCS_READONLY_SCOPES)
+    return credentials
+
+
+def _handle_paragraph(paragraph, parts, stack):
+    """Append a paragraph's text runs followed by a newline."""
+    for elem in paragraph.get('elements', []):
+        text_run = elem.get('textRun')
+        if text_run:
+            parts.append(text_run.get('content', ''))
+    parts.append('\n')
+
+
+def _handle_table(table, parts, stack):
+    """Queue table cell contents: ' | ' after each cell, a newline after each row."""
+    children = []
+    for row in table.get('tableRows', []):
+        for cell in row.get('tableCells', []):
+            children.extend(cell.get('content', []))
+            children.append(' | ')
+        children.append('\n')
+    stack.extendleft(reversed(children))
+
+
+def _handle_table_of_contents(table_of_contents, parts, stack):
+    """Queue the table of contents' paragraphs."""
+    stack.extendleft(reversed(table_of_contents.get('content', [])))
+
+
+# Docs API structural element kinds that can hold text. Anything else
+# (sectionBreak, startIndex/endIndex, styles) is skipped without being walked.
+_CONTENT_HANDLERS = {
+    'paragraph': _handle_paragraph,
+    'table': _handle_table,
+    'tableOfContents': _handle_table_of_contents,
+}
+
+
+def extract_text_from_content(content):
+    """
+    Extract plain text from a list of Docs API structural elements.
     
-    # Priority 2: Service account
-    creds_path = os.getenv('GOOGLE_CREDENTIALS_PATH')
-    if creds_path and os.path.exists(creds_path):
-        return service_account.Credentials.from_service_account_file(
-            creds_path,
-            scopes=['https://www.googleapis.com/auth/documents',
-                   'https://www.googleapis.com/auth/drive']
-        )
+    Walks the content iteratively with an explicit stack (no recursion),
+    dispatching on element kind, and collects text pieces in a list that is
+    joined once at the end. Tables are rendered as one line per row with
+    cells separated by ' | '.
+    """
+    parts = []
+    # Items are structural elements (dicts) or literal separators (str)
+    stack = deque(content)
     
-    # Priority 3: API key (limited access)
-    api_key = os.getenv('GOOGLE_API_KEY')
-    if not api_key:
-        raise ValueError("No authentication method available. Please set up OAuth2, service account, or API key.")
+    while stack:
+        item = stack.popleft()
+        if isinstance(item, str):
+            parts.append(item)
+            continue
+        for kind, value in item.items():
+            handler = _CONTENT_HANDLERS.get(kind)
+            if handler:
+                handler(value, parts, stack)
+                break
     
-    return api_key
+    return ''.join(parts).strip()
 
 
 def extract_text_from_doc(doc_id, credentials=None):
@@ -66,55 +145,27 @@ def extract_text_from_doc(doc_id, credentials=None):
         str: Plain text content of the document
     """
     try:
+        # Get document content (only the fields the extractor reads)
+        url = DOCS_GET_URL.format(doc_id=doc_id)
+        params = {'fields': DOC_TEXT_FIELDS}
+        headers = {}
+        session = _get_session()
         if isinstance(credentials, str):
             # Using API key (limited access)
-            service = build('docs', 'v1', developerKey=credentials)
+            params['key'] = credentials
         else:
-            # Using OAuth credentials
-            service = build('docs', 'v1', credentials=credentials)
-        
-        # Get document content
-        doc = service.documents().get(documentId=doc_id).execute()
-        
-        # Extract text from all elements
-        text_content = []
-        
-        def extract_text_from_element(element):
-            """Recursively extract text from document elements."""
-            if 'textRun' in element:
-                return element['textRun'].get('content', '')
-            elif 'paragraph' in element:
-                para_text = ''
-                for elem in element['paragraph'].get('elements', []):
-                    para_text += extract_text_from_element(elem)
-                return para_text + '\n'
-            elif 'table' in element:
-                table_text = ''
-                for row in element['table'].get('tableRows', []):
-                    for cell in row.get('tableCells', []):
-                        for elem in cell.get('content', []):
-                            table_text += extract_text_from_element(elem)
-                        table_text += ' | '
-                    table_text += '\n'
-                return table_text
-            else:
-                # Recursively process nested elements
-                text = ''
-                for key, value in element.items():
-                    if isinstance(value, list):
-                        for item in value:
-                            text += extract_text_from_element(item)
-                    elif isinstance(value, dict):
-                        text += extract_text_from_element(value)
-                return text
+            # Using OAuth credentials: refreshes the token if needed and sets the bearer header
+            if credentials is None:
+                credentials = _default_credentials()
+            credentials.before_request(AuthRequest(session), 'GET', url, headers)
         
-        # Process all content
-        for element in doc.get('body', {}).get('content', []):
-            text_content.append(extract_text_from_element(element))
+        response = session.get(url, params=params, headers=headers, timeout=60)
+        response.raise_for_status()
+        doc = orjson.loads(response.content) if ORJSON_AVAILABLE else json.loads(response.content)
         
-        return ''.join(text_content).strip()
+        return extract_text_from_content(doc.get('body', {}).get('content', []))
     
-    except HttpError as error:
+    except requests.HTTPError as error:
         print(f"An error occurred: {error}", file=sys.stderr)
         raise
     except Exception as e:
@@ -0,0 +1,92 @@
+"""
+Exact-match cache for AI grading results, backed by SQLite.
+Re-grading identical text with the same rubric, model and instructions returns the stored result.
+"""
+import os
+import sys
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+from pathlib import Path
+from typing import Dict, Any, Optional
+
+try:
+    import orjson
+    ORJSON_AVAILABLE = True
+except ImportError:
+    ORJSON_AVAILABLE = False
+
+
+CACHE_PATH = Path(os.getenv('GRADER_CACHE_PATH', str(Path.home() / '.cache' / 'grader' / 'grading_cache.sqlite3')))
+DEFAULT_TTL = 7 * 24 * 60 * 60
+
+# One connection per process, shared across threads under a lock
+_connection = None
+_lock = threading.Lock()
+
+
+def make_key(document_text: str, rubric: Dict[str, Any], model_name: str, custom_instructions: str = None) -> str:
+    """Hash everything that determines a grading result."""
+    # Stdlib json for the rubric so keys do not depend on whether orjson is installed
+    rubric_bytes = json.dumps(rubric, sort_keys=True).encode('utf-8')
+    
+    h = hashlib.sha256()
+    for part in (document_text.encode('utf-8'), rubric_bytes, model_name.encode('utf-8'), (custom_instructions or '').encode('utf-8')):
+        h.update(part)
+        h.update(b"\0")
+    return h.hexdigest()
+
+
+def _connect() -> sqlite3.Connection:
+    """Open the cache database on first use and drop expired entries."""
+    global _connection
+    if _connection is None:
+        CACHE_PATH.parent.mkdir(parents=True, exist_ok=True)
+        conn = sqlite3.connect(str(CACHE_PATH), timeout=5, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS grading_results ("
+            "key TEXT PRIMARY KEY, value BLOB NOT NULL, expires_at REAL NOT NULL)"
+        )
+        conn.execute("DELETE FROM grading_results WHERE expires_at < ?", (time.time(),))
+        conn.commit()
+        _connection = conn
+    return _connection
+
+
+def get_result(key: str) -> Optional[Dict[str, Any]]:
+    """
+    Look up a cached grading result.
+    
+    Returns:
+        The stored result, or None on a miss, an expired entry, or a cache error
+    """
+    try:
+        with _lock:
+            row = _connect().execute(
+                "SELECT value FROM grading_results WHERE key = ? AND expires_at >= ?",
+                (key, time.time())
+            ).fetchone()
+        if row is None:
+            return None
+        return orjson.loads(row[0]) if ORJSON_AVAILABLE else json.loads(row[0])
+    except (sqlite3.Error, OSError, ValueError) as e:
+        print(f"Warning: Could not read grading cache: {e}", file=sys.stderr)
+        return None
+
+
+def set_result(key: str, result: Dict[str, Any], ttl: int = DEFAULT_TTL):
+    """Store a grading result; failures only cost a Gemini call next time."""
+    value = orjson.dumps(result) if ORJSON_AVAILABLE else json.dumps(result).encode('utf-8')
+    try:
+        with _lock:
+            conn = _connect()
+            conn.execute(
+                "INSERT OR REPLACE INTO grading_results (key, value, expires_at) VALUES (?, ?, ?)",
+                (key, value, time.time() + ttl)
+            )
+            conn.commit()
+    except (sqlite3.Error, OSError) as e:
+        print(f"Warning: Could not save grading result to cache: {e}", file=sys.stderr)
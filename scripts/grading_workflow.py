@@ -5,40 +5,110 @@ Coordinates all operations: extract text, AI grading, insert feedback, insert ru
 import os
 import sys
 import json
+import asyncio
+import functools
 import tempfile
+import logging
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from dotenv import load_dotenv
+from googleapiclient.discovery import build
+from googleapiclient.errors import HttpError
+try:
+    import orjson
+    ORJSON_AVAILABLE = True
+except ImportError:
+    ORJSON_AVAILABLE = False
 
 # Add scripts directory to path for imports
 sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
 
-# Import our modules
+# Import our modules. ai_grader (google.generativeai) and the insert_* modules are
+# imported where they are used, so CLI startup and early exits don't load them.
 from extract_text import extract_text_from_doc, get_credentials as get_docs_credentials
-from ai_grader import grade_with_ai, load_rubric
-from insert_feedback import insert_feedback_text, get_credentials as get_feedback_credentials
-from insert_rubric import insert_rubric_table, get_credentials as get_rubric_credentials
 
 
 # Load environment variables
 load_dotenv()
 
+# Errors are logged with tracebacks; formatting is deferred until a handler emits them
+logger = logging.getLogger(__name__)
 
+# Documents converted/extracted at once in batch mode (respects Google API quota)
+MAX_CONCURRENT_DOCUMENTS = 8
+
+# Repository paths, resolved once at import
+_SCRIPT_DIR = Path(__file__).resolve().parent
+_REPO_ROOT = _SCRIPT_DIR.parent
+_CONFIG_PATH = _REPO_ROOT / 'config' / 'config.json'
+_RUBRICS_DIR = _REPO_ROOT / 'rubrics'
+
+# Parsed rubrics keyed by (path, mtime), shared read-only across gradings
+_RUBRIC_CACHE = {}
+
+
+def _json_loads(data):
+    """Parse JSON from str or bytes, with orjson when installed."""
+    if ORJSON_AVAILABLE:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+@functools.lru_cache(maxsize=1)
 def load_config():
-    """Load configuration from config.json."""
-    config_path = Path(__file__).parent.parent / 'config' / 'config.json'
-    if config_path.exists():
-        with open(config_path, 'r', encoding='utf-8') as f:
-            return json.load(f)
+    """
+    Load configuration from config.json.
+    The parsed config is memoized (treat it as read-only); call
+    load_config.cache_clear() to pick up edits without restarting.
+    """
+    if _CONFIG_PATH.exists():
+        return _json_loads(_CONFIG_PATH.read_bytes())
     return {}
 
 
-def convert_word_to_google_doc(word_file_id, credentials=None):
+def _use_result_cache(config, custom_instructions):
+    """
+    Whether grading results may be cached: not when custom instructions are combined
+    with a non-zero sampling temperature, since those gradings are meant to vary.
+    """
+    temperature = config.get('ai_model', {}).get('temperature', 0)
+    return not (custom_instructions and temperature > 0)
+
+
+def load_rubric(rubric_path):
+    """Load rubric from JSON file (see ai_grader.load_rubric)."""
+    from ai_grader import load_rubric as _load_rubric
+    return _load_rubric(rubric_path)
+
+
+def _load_rubric_cached(rubric_path):
+    """Load a rubric, reusing the parsed copy until the file's mtime changes."""
+    key = (str(rubric_path), os.path.getmtime(rubric_path))
+    rubric = _RUBRIC_CACHE.get(key)
+    if rubric is None:
+        rubric = load_rubric(str(rubric_path))
+        _RUBRIC_CACHE[key] = rubric
+    return rubric
+
+
+def build_drive_service(credentials=None):
+    """
+    Build a Drive v3 service from credentials or an API key, using the discovery
+    document bundled with googleapiclient instead of fetching it.
+    """
+    if isinstance(credentials, str):
+        return build('drive', 'v3', developerKey=credentials, static_discovery=True, cache_discovery=False)
+    return build('drive', 'v3', credentials=credentials, static_discovery=True, cache_discovery=False)
+
+
+def convert_word_to_google_doc(word_file_id, credentials=None, drive_service=None):
     """
     Convert a Word document to Google Docs format.
     
     Args:
         word_file_id: Google Drive file ID of the Word document
         credentials: Google API credentials
+        drive_service: Optional Drive service to reuse (built from credentials if omitted)
     
     Returns:
         str: Google Docs document ID of the converted document
@@ -46,14 +116,9 @@ def convert_word_to_google_doc(word_file_id, credentials=None):
     Raises:
         Exception: If conversion fails
     """
-    from googleapiclient.discovery import build
-    from googleapiclient.errors import HttpError
-    
     try:
-        if isinstance(credentials, str):
-            drive_service = build('drive', 'v3', developerKey=credentials)
-        else:
-            drive_service = build('drive', 'v3', credentials=credentials)
+        if drive_service is None:
+            drive_service = build_drive_service(credentials)
         
         # Get the original file name
         try:
@@ -63,11 +128,10 @@ def convert_word_to_google_doc(word_file_id, credentials=None):
             raise Exception(f"Could not access Word document {word_file_id}: {str(e)}")
         
         # Remove .docx or .doc extension if present
-        base_name = original_name
-        if base_name.endswith('.docx'):
-            base_name = base_name[:-5]
-        elif base_name.endswith('.doc'):
-            base_name = base_name[:-4]
+        if original_name.endswith('.docx'):
+            base_name = original_name.removesuffix('.docx')
+        else:
+            base_name = original_name.removesuffix('.doc')
         
         # Create a copy with conversion to Google Docs format
         try:
@@ -93,27 +157,23 @@ def convert_word_to_google_doc(word_file_id, credentials=None):
         raise
 
 
-def rename_document_to_graded(doc_id, credentials=None):
+def rename_document_to_graded(doc_id, credentials=None, drive_service=None):
     """
     Rename a Google Docs file to include "Graded" in the name.
     
     Args:
         doc_id: Google Drive file ID of the document
         credentials: Google API credentials
+        drive_service: Optional Drive service to reuse (built from credentials if omitted)
     
     Returns:
         bool: True if rename was successful, False otherwise
     """
-    from googleapiclient.discovery import build
-    from googleapiclient.errors import HttpError
-    
     try:
-        if isinstance(credentials, str):
-            drive_service = build('drive', 'v3', developerKey=credentials)
-        else:
-            drive_service = build('drive', 'v3', credentials=credentials)
+        if drive_service is None:
+            drive_service = build_drive_service(credentials)
         
-        # Get the current file name
+        # Get current file name
         try:
             file_metadata = drive_service.files().get(fileId=doc_id, fields='name').execute()
             current_name = file_metadata.get('name', 'Document')
@@ -149,25 +209,21 @@ def rename_document_to_graded(doc_id, credentials=None):
         return False
 
 
-def delete_word_document(word_file_id, credentials=None):
+def delete_word_document(word_file_id, credentials=None, drive_service=None):
     """
     Delete a Word document from Google Drive.
     
     Args:
         word_file_id: Google Drive file ID of the Word document to delete
         credentials: Google API credentials
+        drive_service: Optional Drive service to reuse (built from credentials if omitted)
     
     Returns:
         bool: True if deletion was successful, False otherwise
     """
-    from googleapiclient.discovery import build
-    from googleapiclient.errors import HttpError
-    
     try:
-        if isinstance(credentials, str):
-            drive_service = build('drive', 'v3', developerKey=credentials)
-        else:
-            drive_service = build('drive', 'v3', credentials=credentials)
+        if drive_service is None:
+            drive_service = build_drive_service(credentials)
         
         # Delete the file
         drive_service.files().delete(fileId=word_file_id).execute()
@@ -185,7 +241,75 @@ def delete_word_document(word_file_id, credentials=None):
         return False
 
 
-def grade_document(doc_id, rubric_path=None, config=None, custom_instructions=None, is_word_doc=False):
+def _resolve_rubric_path(rubric_path, config):
+    """Return rubric_path, or the config's default rubric if none was given."""
+    if rubric_path is None:
+        default_rubric = config.get('default_rubric', 'memo_rubric.json')
+        rubric_path = _RUBRICS_DIR / default_rubric
+    return rubric_path
+
+
+def _error_result(error, doc_id, original_doc_id, is_word_doc):
+    """Build a failed grading result, including original/converted IDs for Word docs."""
+    error_result = {
+        'success': False,
+        'error': error,
+        'doc_id': doc_id
+    }
+    if is_word_doc:
+        error_result['original_doc_id'] = original_doc_id
+        if doc_id != original_doc_id:
+            error_result['converted_doc_id'] = doc_id
+    return error_result
+
+
+def _prepare_grading(doc_id, rubric_path, is_word_doc, credentials, drive_service=None):
+    """
+    Steps 0-2 shared by the grading entry points: convert a Word doc to Google Docs
+    if needed, then extract the text and load the rubric concurrently.
+    
+    Returns:
+        tuple: (doc_id, document_text, rubric, None) on success, where doc_id is the
+               Google Doc ID (converted if was Word), or (doc_id, None, None, error_result)
+    """
+    original_doc_id = doc_id
+    
+    # Step 0: Convert Word doc to Google Docs if needed
+    if is_word_doc:
+        print(f"Converting Word document {doc_id} to Google Docs format...", file=sys.stderr)
+        try:
+            doc_id = convert_word_to_google_doc(doc_id, credentials, drive_service)
+            print(f"Converted to Google Docs: {doc_id}", file=sys.stderr)
+        except Exception as conv_error:
+            error_msg = f"Failed to convert Word document to Google Docs: {str(conv_error)}"
+            logger.exception(error_msg)
+            return doc_id, None, None, _error_result(error_msg, original_doc_id, original_doc_id, is_word_doc)
+    
+    # Steps 1-2: Extract text (network-bound) while the rubric loads (disk-bound)
+    try:
+        print(f"Extracting text from document {doc_id}...", file=sys.stderr)
+        print(f"Loading rubric from {rubric_path}...", file=sys.stderr)
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            rubric_future = executor.submit(_load_rubric_cached, rubric_path)
+            document_text = extract_text_from_doc(doc_id, credentials)
+            rubric = rubric_future.result()
+    except Exception as e:
+        logger.exception("Error in grading workflow: %s", e)
+        return doc_id, None, None, _error_result(str(e), doc_id, original_doc_id, is_word_doc)
+    
+    # extract_text_from_doc already strips its output, so the length is the check
+    if len(document_text) < 10:
+        return doc_id, None, None, {
+            'success': False,
+            'error': 'Document appears to be empty or could not extract text',
+            'doc_id': doc_id,
+            'original_doc_id': original_doc_id if is_word_doc else None
+        }
+    
+    return doc_id, document_text, rubric, None
+
+
+def grade_document(doc_id, rubric_path=None, config=None, custom_instructions=None, is_word_doc=False, force_refresh=False):
     """
     Complete grading workflow for a single document.
     
@@ -195,6 +319,7 @@ def grade_document(doc_id, rubric_path=None, config=None, custom_instructions=No
         config: Configuration dictionary (optional)
         custom_instructions: Optional custom instructions for the AI grader
         is_word_doc: If True, convert Word doc to Google Docs first
+        force_refresh: If True, regrade even if a cached result exists
     
     Returns:
         dict: Result with status, scores, and any errors
@@ -202,11 +327,7 @@ def grade_document(doc_id, rubric_path=None, config=None, custom_instructions=No
     if config is None:
         config = load_config()
     
-    # Determine rubric to use
-    if rubric_path is None:
-        default_rubric = config.get('default_rubric', 'memo_rubric.json')
-        rubric_path = Path(__file__).parent.parent / 'rubrics' / default_rubric
-    
+    rubric_path = _resolve_rubric_path(rubric_path, config)
     if not os.path.exists(rubric_path):
         return {
             'success': False,
@@ -214,87 +335,50 @@ def grade_document(doc_id, rubric_path=None, config=None, custom_instructions=No
             'doc_id': doc_id
         }
     
+    original_doc_id = doc_id
     try:
-        # Step 0: Convert Word doc to Google Docs if needed
-        original_doc_id = doc_id
-        if is_word_doc:
-            print(f"Converting Word document {doc_id} to Google Docs format...", file=sys.stderr)
-            try:
-                credentials = get_docs_credentials()
-                doc_id = convert_word_to_google_doc(doc_id, credentials)
-                print(f"Converted to Google Docs: {doc_id}", file=sys.stderr)
-            except Exception as conv_error:
-                error_msg = f"Failed to convert Word document to Google Docs: {str(conv_error)}"
-                print(error_msg, file=sys.stderr)
-                import traceback
-                traceback.print_exc()
-                return {
-                    'success': False,
-                    'error': error_msg,
-                    'doc_id': original_doc_id,
-                    'original_doc_id': original_doc_id
-                }
-        
-        # Step 1: Extract text from document (now it's a Google Doc)
-        print(f"Extracting text from document {doc_id}...", file=sys.stderr)
+        # Credentials and Drive service are shared by every step below
         credentials = get_docs_credentials()
-        document_text = extract_text_from_doc(doc_id, credentials)
+        drive_service = build_drive_service(credentials)
         
-        if not document_text or len(document_text.strip()) < 10:
-            return {
-                'success': False,
-                'error': 'Document appears to be empty or could not extract text',
-                'doc_id': doc_id,
-                'original_doc_id': original_doc_id if is_word_doc else None
-            }
+        # Steps 0-2: Convert (if Word), extract text, load rubric
+        doc_id, document_text, rubric, error_result = _prepare_grading(doc_id, rubric_path, is_word_doc, credentials, drive_service)
+        if error_result:
+            return error_result
         
-        # Step 2: Load rubric
-        print(f"Loading rubric from {rubric_path}...", file=sys.stderr)
-        rubric = load_rubric(str(rubric_path))
+        from ai_grader import grade_with_ai
+        from insert_rubric import insert_feedback_and_rubric, get_credentials as get_insert_credentials
         
         # Step 3: Grade with AI
         print("Grading with AI...", file=sys.stderr)
         model_name = config.get('ai_model', {}).get('name', 'gemini-1.5-flash')
-        grading_result = grade_with_ai(document_text, rubric, model_name, custom_instructions)
-        
-        # Step 4: Insert structured feedback text
-        print("Inserting structured feedback...", file=sys.stderr)
-        feedback_creds = get_feedback_credentials()
-        feedback_success = insert_feedback_text(
-            doc_id,
-            grading_result.get('strengths', ''),
-            grading_result.get('key_issues', ''),
-            grading_result.get('suggestions', ''),
-            feedback_creds,
-            'Feedback'
-        )
-        
-        if not feedback_success:
-            print("Warning: Feedback text may not have been inserted correctly", file=sys.stderr)
+        grading_result = grade_with_ai(document_text, rubric, model_name, custom_instructions,
+                                       force_refresh=force_refresh, use_cache=_use_result_cache(config, custom_instructions))
         
-        # Step 5: Insert rubric as formatted list
-        print("Inserting rubric...", file=sys.stderr)
-        rubric_creds = get_rubric_credentials()
+        # Steps 4-5: Insert structured feedback text and the rubric as a formatted list,
+        # in one batchUpdate so the two pages can't interleave
+        print("Inserting structured feedback and rubric...", file=sys.stderr)
         page_title = config.get('document', {}).get('rubric_page_title', 'Grading Rubric')
-        rubric_success = insert_rubric_table(
+        feedback_success, rubric_success = insert_feedback_and_rubric(
             doc_id,
+            grading_result,
             rubric,
-            grading_result.get('scores', {}),
-            grading_result.get('total_score', 0),
-            rubric_creds,
-            page_title,
-            grading_result.get('criterion_comments', {})
+            get_insert_credentials(),
+            'Feedback',
+            page_title
         )
         
+        if not feedback_success:
+            print("Warning: Feedback text may not have been inserted correctly", file=sys.stderr)
         if not rubric_success:
             print("Warning: Rubric table may not have been inserted correctly", file=sys.stderr)
         
         # Step 6: Rename document to include "Graded"
-        if feedback_success and rubric_success:
+        # (converted Word docs were already named "<name> (Graded)" by the copy)
+        if feedback_success and rubric_success and not is_word_doc:
             print(f"Renaming document {doc_id} to include 'Graded'...", file=sys.stderr)
             try:
-                rename_creds = get_docs_credentials()
-                rename_success = rename_document_to_graded(doc_id, rename_creds)
+                rename_success = rename_document_to_graded(doc_id, credentials, drive_service)
                 if not rename_success:
                     print("Warning: Document rename may have failed", file=sys.stderr)
             except Exception as e:
@@ -305,8 +389,7 @@ def grade_document(doc_id, rubric_path=None, config=None, custom_instructions=No
         if is_word_doc and feedback_success and rubric_success:
             print(f"Deleting original Word document {original_doc_id}...", file=sys.stderr)
             try:
-                delete_creds = get_docs_credentials()
-                word_deleted = delete_word_document(original_doc_id, delete_creds)
+                word_deleted = delete_word_document(original_doc_id, credentials, drive_service)
             except Exception as e:
                 print(f"Warning: Could not delete original Word document: {e}", file=sys.stderr)
         
@@ -336,23 +419,11 @@ def grade_document(doc_id, rubric_path=None, config=None, custom_instructions=No
         return result
     
     except Exception as e:
-        print(f"Error in grading workflow: {e}", file=sys.stderr)
-        import traceback
-        traceback.print_exc()
-        error_result = {
-            'success': False,
-            'error': str(e),
-            'doc_id': doc_id if 'doc_id' in locals() else original_doc_id if 'original_doc_id' in locals() else None
-        }
-        # Include original/converted IDs if they exist
-        if is_word_doc and 'original_doc_id' in locals():
-            error_result['original_doc_id'] = original_doc_id
-            if 'doc_id' in locals() and doc_id != original_doc_id:
-                error_result['converted_doc_id'] = doc_id
-        return error_result
+        logger.exception("Error in grading workflow: %s", e)
+        return _error_result(str(e), doc_id, original_doc_id, is_word_doc)
 
 
-def grade_document_for_review(doc_id, rubric_path=None, config=None, custom_instructions=None, is_word_doc=False):
+def grade_document_for_review(doc_id, rubric_path=None, config=None, custom_instructions=None, is_word_doc=False, force_refresh=False):
     """
     Grade a document for review workflow - does NOT update Google Docs.
     Only extracts text, grades with AI, and returns results.
@@ -364,6 +435,7 @@ def grade_document_for_review(doc_id, rubric_path=None, config=None, custom_inst
         config: Configuration dictionary (optional)
         custom_instructions: Optional custom instructions for the AI grader
         is_word_doc: If True, convert Word doc to Google Docs first
+        force_refresh: If True, regrade even if a cached result exists
     
     Returns:
         dict: Result with status, scores, document_text, and any errors
@@ -371,11 +443,7 @@ def grade_document_for_review(doc_id, rubric_path=None, config=None, custom_inst
     if config is None:
         config = load_config()
     
-    # Determine rubric to use
-    if rubric_path is None:
-        default_rubric = config.get('default_rubric', 'memo_rubric.json')
-        rubric_path = Path(__file__).parent.parent / 'rubrics' / default_rubric
-    
+    rubric_path = _resolve_rubric_path(rubric_path, config)
     if not os.path.exists(rubric_path):
         return {
             'success': False,
@@ -383,48 +451,24 @@ def grade_document_for_review(doc_id, rubric_path=None, config=None, custom_inst
             'doc_id': doc_id
         }
     
+    original_doc_id = doc_id
     try:
-        # Step 0: Convert Word doc to Google Docs if needed
-        original_doc_id = doc_id
-        if is_word_doc:
-            print(f"Converting Word document {doc_id} to Google Docs format...", file=sys.stderr)
-            try:
-                credentials = get_docs_credentials()
-                doc_id = convert_word_to_google_doc(doc_id, credentials)
-                print(f"Converted to Google Docs: {doc_id}", file=sys.stderr)
-            except Exception as conv_error:
-                error_msg = f"Failed to convert Word document to Google Docs: {str(conv_error)}"
-                print(error_msg, file=sys.stderr)
-                import traceback
-                traceback.print_exc()
-                return {
-                    'success': False,
-                    'error': error_msg,
-                    'doc_id': original_doc_id,
-                    'original_doc_id': original_doc_id
-                }
-        
-        # Step 1: Extract text from document (now it's a Google Doc)
-        print(f"Extracting text from document {doc_id}...", file=sys.stderr)
+        # Credentials (and the Drive service, for conversion) are shared by the steps below
         credentials = get_docs_credentials()
-        document_text = extract_text_from_doc(doc_id, credentials)
+        drive_service = build_drive_service(credentials) if is_word_doc else None
         
-        if not document_text or len(document_text.strip()) < 10:
-            return {
-                'success': False,
-                'error': 'Document appears to be empty or could not extract text',
-                'doc_id': doc_id,
-                'original_doc_id': original_doc_id if is_word_doc else None
-            }
+        # Steps 0-2: Convert (if Word), extract text, load rubric
+        doc_id, document_text, rubric, error_result = _prepare_grading(doc_id, rubric_path, is_word_doc, credentials, drive_service)
+        if error_result:
+            return error_result
         
-        # Step 2: Load rubric
-        print(f"Loading rubric from {rubric_path}...", file=sys.stderr)
-        rubric = load_rubric(str(rubric_path))
+        from ai_grader import grade_with_ai
         
         # Step 3: Grade with AI
         print("Grading with AI...", file=sys.stderr)
         model_name = config.get('ai_model', {}).get('name', 'gemini-1.5-flash')
-        grading_result = grade_with_ai(document_text, rubric, model_name, custom_instructions)
+        grading_result = grade_with_ai(document_text, rubric, model_name, custom_instructions,
+                                       force_refresh=force_refresh, use_cache=_use_result_cache(config, custom_instructions))
         
         # Return result WITHOUT updating Google Docs
         result = {
@@ -449,20 +493,200 @@ def grade_document_for_review(doc_id, rubric_path=None, config=None, custom_inst
         return result
     
     except Exception as e:
-        print(f"Error in grading workflow: {e}", file=sys.stderr)
-        import traceback
-        traceback.print_exc()
-        error_result = {
+        logger.exception("Error in grading workflow: %s", e)
+        return _error_result(str(e), doc_id, original_doc_id, is_word_doc)
+
+
+def _prepare_document(doc_id, is_word_doc):
+    """
+    Convert (if Word) and extract text for one document.
+    
+    Returns:
+        tuple: (original_doc_id, (doc_id, document_text)) on success,
+               or (original_doc_id, error_result) on failure
+    """
+    original_doc_id = doc_id
+    try:
+        # Process-wide credentials (see _google_auth); HTTP clients are per thread
+        credentials = get_docs_credentials()
+        if is_word_doc:
+            print(f"Converting Word document {doc_id} to Google Docs format...", file=sys.stderr)
+            try:
+                doc_id = convert_word_to_google_doc(doc_id, credentials)
+                print(f"Converted to Google Docs: {doc_id}", file=sys.stderr)
+            except Exception as conv_error:
+                error_msg = f"Failed to convert Word document to Google Docs: {str(conv_error)}"
+                logger.exception(error_msg)
+                return original_doc_id, {
+                    'success': False,
+                    'error': error_msg,
+                    'doc_id': original_doc_id,
+                    'original_doc_id': original_doc_id
+                }
+        
+        print(f"Extracting text from document {doc_id}...", file=sys.stderr)
+        document_text = extract_text_from_doc(doc_id, credentials)
+        
+        # extract_text_from_doc already strips its output, so the length is the check
+        if len(document_text) < 10:
+            return original_doc_id, {
+                'success': False,
+                'error': 'Document appears to be empty or could not extract text',
+                'doc_id': doc_id,
+                'original_doc_id': original_doc_id if is_word_doc else None
+            }
+        
+        return original_doc_id, (doc_id, document_text)
+    except Exception as e:
+        logger.exception("Error preparing document %s: %s", original_doc_id, e)
+        return original_doc_id, _error_result(str(e), doc_id, original_doc_id, is_word_doc)
+
+
+def _prepare_documents(doc_ids, doc_types):
+    """Prepare all documents concurrently, at most MAX_CONCURRENT_DOCUMENTS at a time."""
+    with ThreadPoolExecutor(max_workers=max(1, min(len(doc_ids), MAX_CONCURRENT_DOCUMENTS))) as executor:
+        return list(executor.map(
+            lambda doc_id: _prepare_document(doc_id, doc_types.get(doc_id, False)),
+            doc_ids
+        ))
+
+
+def grade_documents_for_review(doc_ids, rubric_path=None, config=None, custom_instructions=None, doc_types=None, force_refresh=False):
+    """
+    Grade several documents for the review workflow - does NOT update Google Docs.
+    Documents are graded together so they share Gemini requests where possible.
+    
+    Args:
+        doc_ids: List of Google Docs document IDs (or Word doc IDs, see doc_types)
+        rubric_path: Path to rubric JSON file (optional, uses default from config)
+        config: Configuration dictionary (optional)
+        custom_instructions: Optional custom instructions for the AI grader
+        doc_types: Optional dict of {doc_id: True if Word doc, False if Google Doc}
+        force_refresh: If True, regrade even if cached results exist
+    
+    Returns:
+        list: One result per doc_id, in order, shaped like grade_document_for_review's result
+    """
+    if config is None:
+        config = load_config()
+    doc_types = doc_types or {}
+    
+    rubric_path = _resolve_rubric_path(rubric_path, config)
+    if not os.path.exists(rubric_path):
+        return [{
             'success': False,
-            'error': str(e),
-            'doc_id': doc_id if 'doc_id' in locals() else original_doc_id if 'original_doc_id' in locals() else None
-        }
-        # Include original/converted IDs if they exist
-        if is_word_doc and 'original_doc_id' in locals():
-            error_result['original_doc_id'] = original_doc_id
-            if 'doc_id' in locals() and doc_id != original_doc_id:
-                error_result['converted_doc_id'] = doc_id
-        return error_result
+            'error': f'Rubric file not found: {rubric_path}',
+            'doc_id': doc_id
+        } for doc_id in doc_ids]
+    
+    print(f"Loading rubric from {rubric_path}...", file=sys.stderr)
+    rubric = _load_rubric_cached(rubric_path)
+    
+    # Steps 0-1 for each document: convert Word docs and extract text, concurrently
+    results = {}
+    extracted = {}
+    for original_doc_id, outcome in _prepare_documents(doc_ids, doc_types):
+        if isinstance(outcome, tuple):
+            extracted[original_doc_id] = outcome
+        else:
+            results[original_doc_id] = outcome
+    
+    # Steps 2-3: Grade all extracted documents together
+    if extracted:
+        from ai_grader import grade_batch_with_ai
+        print(f"Grading {len(extracted)} documents with AI...", file=sys.stderr)
+        model_name = config.get('ai_model', {}).get('name', 'gemini-1.5-flash')
+        try:
+            graded = grade_batch_with_ai(
+                [(original_doc_id, document_text) for original_doc_id, (_, document_text) in extracted.items()],
+                rubric,
+                model_name,
+                custom_instructions,
+                force_refresh=force_refresh,
+                use_cache=_use_result_cache(config, custom_instructions)
+            )
+        except Exception as e:
+            logger.exception("Error in grading workflow: %s", e)
+            graded = {original_doc_id: e for original_doc_id in extracted}
+        
+        for original_doc_id, (doc_id, document_text) in extracted.items():
+            is_word_doc = doc_types.get(original_doc_id, False)
+            grading_result = graded.get(original_doc_id)
+            if isinstance(grading_result, Exception):
+                logger.warning("Grading failed for document %s: %s", original_doc_id, grading_result, exc_info=grading_result)
+            if not isinstance(grading_result, dict):
+                error_result = {
+                    'success': False,
+                    'error': str(grading_result) if grading_result else 'Document was not graded',
+                    'doc_id': doc_id
+                }
+                if is_word_doc:
+                    error_result['original_doc_id'] = original_doc_id
+                    error_result['converted_doc_id'] = doc_id
+                results[original_doc_id] = error_result
+                continue
+            
+            result = {
+                'success': True,
+                'doc_id': doc_id,  # The Google Doc ID (converted if was Word)
+                'document_text': document_text,  # Include document text for review
+                'scores': grading_result.get('scores', {}),
+                'total_score': grading_result.get('total_score', 0),
+                'strengths': grading_result.get('strengths', ''),
+                'key_issues': grading_result.get('key_issues', ''),
+                'suggestions': grading_result.get('suggestions', ''),
+                'criterion_comments': grading_result.get('criterion_comments', {}),
+                'rubric': rubric  # Include rubric for reference
+            }
+            
+            # Include original doc ID if it was converted
+            if is_word_doc:
+                result['original_doc_id'] = original_doc_id
+                result['converted_doc_id'] = doc_id
+                result['message'] = f'Word document converted to Google Docs: {doc_id}'
+            
+            results[original_doc_id] = result
+    
+    return [results[doc_id] for doc_id in doc_ids]
+
+
+async def grade_documents_batch(doc_ids, rubric_path=None, config=None, custom_instructions=None, doc_types=None, max_concurrent=MAX_CONCURRENT_DOCUMENTS, force_refresh=False):
+    """
+    Run the complete grading workflow (grade_document) for several documents at once.
+    
+    Each document runs in a worker thread of one pool shared by the whole batch,
+    so at most max_concurrent documents are in flight at a time.
+    
+    Args:
+        doc_ids: List of Google Docs document IDs (or Word doc IDs, see doc_types)
+        rubric_path: Path to rubric JSON file (optional, uses default from config)
+        config: Configuration dictionary (optional)
+        custom_instructions: Optional custom instructions for the AI grader
+        doc_types: Optional dict of {doc_id: True if Word doc, False if Google Doc}
+        max_concurrent: Maximum number of documents processed at the same time
+        force_refresh: If True, regrade even if cached results exist
+    
+    Returns:
+        list: One grade_document result per doc_id, in order
+    """
+    if config is None:
+        config = load_config()
+    doc_types = doc_types or {}
+    
+    loop = asyncio.get_running_loop()
+    with ThreadPoolExecutor(max_workers=max(1, max_concurrent)) as executor:
+        return await asyncio.gather(*(
+            loop.run_in_executor(executor, functools.partial(
+                grade_document,
+                doc_id,
+                rubric_path,
+                config,
+                custom_instructions,
+                doc_types.get(doc_id, False),
+                force_refresh
+            ))
+            for doc_id in doc_ids
+        ))
 
 
 def sync_feedback_to_document(doc_id, feedback_data, rubric=None, config=None):
@@ -482,40 +706,40 @@ def sync_feedback_to_document(doc_id, feedback_data, rubric=None, config=None):
     if config is None:
         config = load_config()
     
+    from insert_feedback import insert_feedback_text, get_credentials as get_feedback_credentials
+    from insert_rubric import insert_feedback_and_rubric
+    
     try:
-        # Step 1: Insert structured feedback text
-        print(f"Inserting structured feedback into document {doc_id}...", file=sys.stderr)
+        # Steps 1-2: Insert structured feedback text, and the rubric as a formatted
+        # list if one was provided (both in one batchUpdate)
         feedback_creds = get_feedback_credentials()
-        feedback_success = insert_feedback_text(
-            doc_id,
-            feedback_data.get('strengths', ''),
-            feedback_data.get('key_issues', ''),
-            feedback_data.get('suggestions', ''),
-            feedback_creds,
-            'Feedback'
-        )
-        
-        if not feedback_success:
-            print("Warning: Feedback text may not have been inserted correctly", file=sys.stderr)
-        
-        # Step 2: Insert rubric as formatted list (if rubric provided)
         rubric_success = True
         if rubric:
-            print(f"Inserting rubric into document {doc_id}...", file=sys.stderr)
-            rubric_creds = get_rubric_credentials()
+            print(f"Inserting structured feedback and rubric into document {doc_id}...", file=sys.stderr)
             page_title = config.get('document', {}).get('rubric_page_title', 'Grading Rubric')
-            rubric_success = insert_rubric_table(
+            feedback_success, rubric_success = insert_feedback_and_rubric(
                 doc_id,
+                feedback_data,
                 rubric,
-                feedback_data.get('scores', {}),
-                feedback_data.get('total_score', 0),
-                rubric_creds,
-                page_title,
-                feedback_data.get('criterion_comments', {})
+                feedback_creds,
+                'Feedback',
+                page_title
             )
-            
-            if not rubric_success:
-                print("Warning: Rubric table may not have been inserted correctly", file=sys.stderr)
+        else:
+            print(f"Inserting structured feedback into document {doc_id}...", file=sys.stderr)
+            feedback_success = insert_feedback_text(
+                doc_id,
+                feedback_data.get('strengths', ''),
+                feedback_data.get('key_issues', ''),
+                feedback_data.get('suggestions', ''),
+                feedback_creds,
+                'Feedback'
+            )
+        
+        if not feedback_success:
+            print("Warning: Feedback text may not have been inserted correctly", file=sys.stderr)
+        if not rubric_success:
+            print("Warning: Rubric table may not have been inserted correctly", file=sys.stderr)
         
         # Step 3: Rename document to include "Graded"
         if feedback_success and rubric_success:
@@ -536,9 +760,7 @@ def sync_feedback_to_document(doc_id, feedback_data, rubric=None, config=None):
         }
     
     except Exception as e:
-        print(f"Error syncing feedback to document: {e}", file=sys.stderr)
-        import traceback
-        traceback.print_exc()
+        logger.exception("Error syncing feedback to document: %s", e)
         return {
             'success': False,
             'error': str(e),
@@ -546,39 +768,115 @@ def sync_feedback_to_document(doc_id, feedback_data, rubric=None, config=None):
         }
 
 
+USAGE = (
+    "Usage: python grading_workflow.py <doc_id> [rubric_path]\n"
+    "       python grading_workflow.py [-j N] [--rubric rubric_path] <doc_id> [doc_id ...]"
+)
+
+
+def _parse_max_concurrent(value):
+    """Parse a -j / max_concurrent value, which must be a positive integer."""
+    try:
+        max_concurrent = int(value)
+    except (TypeError, ValueError):
+        raise ValueError(f"max_concurrent must be a positive integer, got {value!r}")
+    if max_concurrent < 1:
+        raise ValueError(f"max_concurrent must be a positive integer, got {value!r}")
+    return max_concurrent
+
+
+def _parse_args(args):
+    """
+    Parse command line arguments (see USAGE).
+    
+    Without --rubric the original form applies: one document ID and an optional
+    rubric path. With --rubric, every positional argument is a document ID.
+    
+    Returns:
+        tuple: (doc_ids, rubric_path, max_concurrent)
+    
+    Raises:
+        ValueError: On malformed arguments
+    """
+    max_concurrent = MAX_CONCURRENT_DOCUMENTS
+    rubric_path = None
+    rubric_given = False
+    positional = []
+    
+    args = iter(args)
+    for arg in args:
+        if arg in ('-j', '--rubric'):
+            value = next(args, None)
+            if value is None:
+                raise ValueError(f"{arg} requires a value")
+            if arg == '-j':
+                max_concurrent = _parse_max_concurrent(value)
+            else:
+                rubric_path = value
+                rubric_given = True
+        else:
+            positional.append(arg)
+    
+    if not positional:
+        raise ValueError("document_id is required")
+    if rubric_given:
+        return positional, rubric_path, max_concurrent
+    if len(positional) > 2:
+        raise ValueError("pass the rubric with --rubric to grade several documents")
+    return positional[:1], (positional[1] if len(positional) == 2 else None), max_concurrent
+
+
 def main():
     """
     Main function for command-line and n8n usage.
-    Expects JSON input with document_id and optional rubric_path.
+    Expects JSON input with document_id (or document_ids) and optional rubric_path.
     """
+    logging.basicConfig(level=os.getenv('GRADER_LOG_LEVEL', 'INFO'))
+    
     # Read input from stdin (for n8n) or command line
     if len(sys.argv) > 1:
-        # Command line mode
-        doc_id = sys.argv[1]
-        rubric_path = sys.argv[2] if len(sys.argv) > 2 else None
+        try:
+            doc_ids, rubric_path, max_concurrent = _parse_args(sys.argv[1:])
+        except ValueError as e:
+            print(f"Error: {e}", file=sys.stderr)
+            print(USAGE, file=sys.stderr)
+            sys.exit(1)
     else:
         # Read from stdin (n8n mode)
         try:
-            input_data = json.loads(sys.stdin.read())
-            doc_id = input_data.get('document_id') or input_data.get('doc_id')
+            input_data = _json_loads(sys.stdin.buffer.read())
+            doc_ids = input_data.get('document_ids') or [input_data.get('document_id') or input_data.get('doc_id')]
             rubric_path = input_data.get('rubric_path')
-        except (json.JSONDecodeError, KeyError) as e:
+            max_concurrent = _parse_max_concurrent(input_data.get('max_concurrent', MAX_CONCURRENT_DOCUMENTS))
+        except (ValueError, KeyError, TypeError) as e:  # json and orjson decode errors subclass ValueError
             print(f"Error reading input: {e}", file=sys.stderr)
-            print("Expected JSON with 'document_id' field, or command line: python grading_workflow.py <doc_id> [rubric_path]", file=sys.stderr)
+            print("Expected JSON with 'document_id' field, or command line:", file=sys.stderr)
+            print(USAGE, file=sys.stderr)
             sys.exit(1)
     
-    if not doc_id:
+    doc_ids = [doc_id for doc_id in doc_ids if doc_id]
+    if not doc_ids:
         print("Error: document_id is required", file=sys.stderr)
         sys.exit(1)
     
     # Run grading workflow
-    result = grade_document(doc_id, rubric_path)
+    if len(doc_ids) == 1:
+        result = grade_document(doc_ids[0], rubric_path)
+        success = result.get('success')
+    else:
+        result = asyncio.run(grade_documents_batch(doc_ids, rubric_path, max_concurrent=max_concurrent))
+        success = all(r.get('success') for r in result)
     
-    # Output result as JSON
-    print(json.dumps(result, indent=2))
+    # Output result as JSON, written as bytes and flushed before the exit status is set
+    if ORJSON_AVAILABLE:
+        output = orjson.dumps(result, option=orjson.OPT_INDENT_2)
+    else:
+        output = json.dumps(result, indent=2).encode('utf-8')
+    sys.stdout.buffer.write(output + b"\n")
+    sys.stdout.buffer.flush()
     
     # Exit with error code if failed
-    if not result.get('success'):
+    if not success:
         sys.exit(1)
 
 
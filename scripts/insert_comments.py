@@ -2,105 +2,387 @@
 Insert comments into Google Docs at specific locations.
 """
 import os
+import re
 import sys
 import json
-from google.oauth2.credentials import Credentials
-from google.oauth2 import service_account
+import time
+import random
+import bisect
+import difflib
+import functools
+from pathlib import Path
 from googleapiclient.discovery import build
 from googleapiclient.errors import HttpError
+from googleapiclient.model import JsonModel
+try:
+    import orjson
+    ORJSON_AVAILABLE = True
+except ImportError:
+    ORJSON_AVAILABLE = False
+try:
+    import ahocorasick
+    AHOCORASICK_AVAILABLE = True
+except ImportError:
+    AHOCORASICK_AVAILABLE = False
+try:
+    import hyperscan
+    HYPERSCAN_AVAILABLE = True
+except ImportError:
+    HYPERSCAN_AVAILABLE = False
 
 
-def get_credentials():
-    """Get Google API credentials from OAuth2 token, service account, or API key."""
-    from pathlib import Path
-    from google.oauth2.credentials import Credentials
-    from google.auth.transport.requests import Request
-    
-    project_root = Path(__file__).parent.parent
+# Add scripts directory to path for imports
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from _google_auth import get_credentials
+
+
+# Fetched documents keyed by (doc_id, revisionId), so retries skip the full download;
+# stored as <DOC_CACHE_DIR>/<doc_id>/<revisionId>.json
+DOC_CACHE_DIR = Path(os.getenv('GRADER_DOC_CACHE_DIR', str(Path.home() / '.cache' / 'grader' / 'docs')))
+
+# extract_text_with_indices only reads body content; skip styles, lists, headers, etc.
+DOC_CONTENT_FIELDS = 'body/content'
+
+# Below this many distinct anchors, compiling a Hyperscan database costs more than it saves
+HYPERSCAN_MIN_PATTERNS = 32
+
+# Retries for 429/5xx responses on reads; googleapiclient backs off exponentially with
+# jitter. Writes are not retried this way: a write that succeeded but timed out
+# would be replayed and add every comment twice (see execute_write).
+API_NUM_RETRIES = 5
+
+# batchUpdate attempts when rate limited, with capped exponential backoff and full jitter
+WRITE_MAX_ATTEMPTS = 5
+WRITE_RETRY_BASE_DELAY = 1.0
+WRITE_RETRY_MAX_DELAY = 30.0
+
+# Google's limit on calls in one batched HTTP request
+BATCH_HTTP_MAX_CALLS = 1000
+
+
+def _is_rate_limited(error):
+    """Whether an HttpError is a rate-limit rejection (429, or 403 rateLimitExceeded)."""
+    status = error.resp.status
+    if status == 429:
+        return True
+    return status == 403 and b'ratelimitexceeded' in (error.content or b'').lower()
+
+
+def execute_write(request):
+    """
+    Execute a batchUpdate request, retrying only rate-limit rejections.
     
-    # Priority 1: OAuth2 credentials (for accessing user's own Drive)
-    token_file = project_root / 'token.json'
-    if token_file.exists():
-        try:
-            # Load token without specifying scopes to avoid scope mismatch errors
-            # The token already contains the scopes it was created with
-            creds = Credentials.from_authorized_user_file(str(token_file))
-            if creds and creds.valid:
-                return creds
-            # If expired, try to refresh
-            if creds and creds.expired and creds.refresh_token:
-                creds.refresh(Request())
-                # Save refreshed token
-                with open(token_file, 'w') as token:
-                    token.write(creds.to_json())
-                return creds
-        except Exception as e:
-            print(f"Error loading OAuth token: {e}", file=sys.stderr)
-    
-    # Priority 2: Service account
-    creds_path = os.getenv('GOOGLE_CREDENTIALS_PATH')
-    if creds_path and os.path.exists(creds_path):
-        return service_account.Credentials.from_service_account_file(
-            creds_path,
-            scopes=['https://www.googleapis.com/auth/documents',
-                   'https://www.googleapis.com/auth/drive']
-        )
+    A rate-limited write was not applied, so sending it again cannot duplicate
+    comments. 5xx errors and timeouts are raised at once: the write may already
+    have been applied.
     
-    # Priority 3: API key (limited access)
-    api_key = os.getenv('GOOGLE_API_KEY')
-    if not api_key:
-        raise ValueError("No authentication method available. Please set up OAuth2, service account, or API key.")
+    Args:
+        request: googleapiclient HttpRequest for documents().batchUpdate
     
-    return api_key
+    Returns:
+        dict: The batchUpdate response
+    """
+    failures = 0
+    while True:
+        try:
+            return request.execute()
+        except HttpError as error:
+            failures += 1
+            if not _is_rate_limited(error) or failures >= WRITE_MAX_ATTEMPTS:
+                raise
+            delay = random.uniform(0, min(WRITE_RETRY_MAX_DELAY, WRITE_RETRY_BASE_DELAY * 2 ** failures))
+            print(f"Warning: Docs write rate limited, retrying in {delay:.1f}s", file=sys.stderr)
+            time.sleep(delay)
 
 
 def extract_text_with_indices(doc):
     """
     Extract all text from document with accurate character indices.
-    Returns a list of text segments with their start and end indices.
+    
+    Returns:
+        tuple: Parallel lists (texts, starts, ends, blocks) with one entry per text
+               segment: its text, start and end indices, and the block it belongs
+               to (table cells and section breaks start a new block)
     """
-    text_segments = []
+    texts = []
+    starts = []
+    ends = []
+    blocks = []
     current_index = 1  # Google Docs indices start at 1
+    block = 0
+    new_block = None  # Stack marker: the elements after it are in a new block
     
-    def process_element(element):
-        nonlocal current_index
-        if 'paragraph' in element:
-            para = element['paragraph']
-            for elem in para.get('elements', []):
+    # Walk body content with an explicit stack (tables can nest), in document order
+    stack = list(reversed(doc.get('body', {}).get('content', [])))
+    while stack:
+        element = stack.pop()
+        if element is new_block:
+            block += 1
+        elif 'paragraph' in element:
+            for elem in element['paragraph'].get('elements', []):
+                # Page breaks and other non-text elements don't add to text index
                 if 'textRun' in elem:
                     text = elem['textRun'].get('content', '')
                     if text:  # Only add non-empty text
-                        start = current_index
                         end = current_index + len(text)
-                        text_segments.append({
-                            'text': text,
-                            'start': start,
-                            'end': end
-                        })
+                        texts.append(text)
+                        starts.append(current_index)
+                        ends.append(end)
+                        blocks.append(block)
                         current_index = end
-                elif 'pageBreak' in elem:
-                    # Page breaks don't add to text index
-                    pass
         elif 'table' in element:
-            # Process table cells
-            table = element['table']
-            for row in table.get('tableRows', []):
+            # Process table cells; text after the table is outside its cells
+            cells = []
+            for row in element['table'].get('tableRows', []):
                 for cell in row.get('tableCells', []):
-                    for content_elem in cell.get('content', []):
-                        process_element(content_elem)
+                    cells.append(new_block)
+                    cells.extend(cell.get('content', []))
+            cells.append(new_block)
+            stack.extend(reversed(cells))
         elif 'sectionBreak' in element:
             # Section breaks
-            pass
+            block += 1
+    
+    return texts, starts, ends, blocks
+
+
+def get_doc_cached(doc_service, doc_id, use_cache=True):
+    """
+    Fetch a document, reusing a copy on disk if its revision has not changed.
+    
+    Args:
+        doc_service: Google Docs API service
+        doc_id: Document ID
+        use_cache: If False, always download the full document
+    
+    Returns:
+        dict: The document resource
+    """
+    if not use_cache:
+        return doc_service.documents().get(documentId=doc_id, fields=DOC_CONTENT_FIELDS).execute(num_retries=API_NUM_RETRIES)
+    
+    revision = doc_service.documents().get(documentId=doc_id, fields='revisionId').execute(num_retries=API_NUM_RETRIES).get('revisionId')
+    if not revision:
+        return doc_service.documents().get(documentId=doc_id, fields=DOC_CONTENT_FIELDS).execute(num_retries=API_NUM_RETRIES)
+    
+    # One directory per document: Drive IDs may contain '-', so a shared
+    # "<doc_id>-<revision>" namespace could match another document's files
+    doc_dir = DOC_CACHE_DIR / doc_id
+    cache_file = doc_dir / f"{revision}.json"
+    try:
+        data = cache_file.read_bytes()
+        return orjson.loads(data) if ORJSON_AVAILABLE else json.loads(data)
+    except FileNotFoundError:
+        pass
+    except (OSError, ValueError) as e:
+        print(f"Warning: Could not read cached document {doc_id}: {e}", file=sys.stderr)
+    
+    doc = doc_service.documents().get(documentId=doc_id, fields=DOC_CONTENT_FIELDS).execute(num_retries=API_NUM_RETRIES)
+    try:
+        doc_dir.mkdir(parents=True, exist_ok=True)
+        # Older revisions of this document will never be read again
+        for stale in doc_dir.glob("*.json"):
+            stale.unlink(missing_ok=True)
+        tmp_file = cache_file.with_suffix('.tmp')
+        tmp_file.write_bytes(orjson.dumps(doc) if ORJSON_AVAILABLE else json.dumps(doc).encode('utf-8'))
+        os.replace(tmp_file, cache_file)
+    except OSError as e:
+        print(f"Warning: Could not cache document {doc_id}: {e}", file=sys.stderr)
+    return doc
+
+
+def fetch_segments(doc_service, doc_id, use_cache=True):
+    """
+    Fetch a document once and prepare it for text searches.
+    
+    Args:
+        doc_service: Google Docs API service
+        doc_id: Document ID
+        use_cache: If False, bypass the on-disk document cache
+    
+    Returns:
+        tuple: (full_text, full_text_folded, text_segments, char_starts), where
+               text_segments is extract_text_with_indices' (texts, starts, ends, blocks)
+               and char_starts[i] is segment i's offset in full_text
+    """
+    doc = get_doc_cached(doc_service, doc_id, use_cache)
+    text_segments = extract_text_with_indices(doc)
+    texts = text_segments[0]
+    
+    # Build full text for searching
+    full_text = ''.join(texts)
+    return full_text, fold_case(full_text), text_segments, _segment_char_starts(texts)
+
+
+@functools.lru_cache(maxsize=None)
+def _fold_char(char):
+    """Case-fold one character, keeping it as is if it would fold to several."""
+    folded = char.casefold()
+    return folded if len(folded) == 1 else char
+
+
+def fold_case(text):
+    """
+    Case-fold text for matching without changing its length, so offsets in the
+    folded text are offsets in the original (e.g. 'ß' would otherwise become 'ss').
+    """
+    folded = text.casefold()
+    if len(folded) == len(text):
+        return folded
+    return ''.join(map(_fold_char, text))
+
+
+def _segment_char_starts(texts):
+    """Cumulative offset of each segment's text within the joined document text."""
+    char_starts = []
+    char_pos = 0
+    for text in texts:
+        char_starts.append(char_pos)
+        char_pos += len(text)
+    return char_starts
+
+
+def _normalize_search_text(search_text):
+    """Collapse whitespace and case-fold text to search for."""
+    return fold_case(' '.join(search_text.split()))
+
+
+def find_exact_matches(full_text_folded, search_texts):
+    """
+    Find the first exact occurrence of every search text in one pass over the
+    document, using a Hyperscan database for many anchors in ASCII text, else an
+    Aho-Corasick automaton (pyahocorasick), else one find per search text.
     
-    # Process all body content
-    body = doc.get('body', {})
-    for element in body.get('content', []):
-        process_element(element)
+    Args:
+        full_text_folded: Case-folded document text, from fetch_segments
+        search_texts: Texts to search for
     
-    return text_segments
+    Returns:
+        dict: {normalized search text: offset in full_text_folded}; texts without
+              an exact match are left out
+    """
+    needles = {_normalize_search_text(text) for text in search_texts}
+    needles.discard('')
+    if not needles:
+        return {}
+    
+    if HYPERSCAN_AVAILABLE and len(needles) >= HYPERSCAN_MIN_PATTERNS and full_text_folded.isascii():
+        return _find_exact_matches_hyperscan(full_text_folded, needles)
+    
+    if not AHOCORASICK_AVAILABLE:
+        matches = {needle: full_text_folded.find(needle) for needle in needles}
+        return {needle: start for needle, start in matches.items() if start != -1}
+    
+    automaton = ahocorasick.Automaton()
+    for needle in needles:
+        automaton.add_word(needle, needle)
+    automaton.make_automaton()
+    
+    # Matches come out in order of their end offset, so the first one seen for a
+    # needle is its first occurrence
+    matches = {}
+    for end, needle in automaton.iter(full_text_folded):
+        if needle not in matches:
+            matches[needle] = end - len(needle) + 1
+            if len(matches) == len(needles):
+                break
+    return matches
 
 
-def find_text_range(doc_service, doc_id, search_text, context_length=50):
+def _find_exact_matches_hyperscan(full_text_folded, needles):
+    """find_exact_matches for ASCII text with a compiled Hyperscan database."""
+    # Non-ASCII needles cannot occur in ASCII text; byte offsets equal char offsets
+    patterns = [needle for needle in needles if needle.isascii()]
+    if not patterns:
+        return {}
+    
+    db = hyperscan.Database()
+    db.compile(
+        expressions=[re.escape(needle).encode('ascii') for needle in patterns],
+        ids=list(range(len(patterns))),
+        elements=len(patterns),
+        flags=[hyperscan.HS_FLAG_SINGLEMATCH] * len(patterns)
+    )
+    
+    # SINGLEMATCH reports only each pattern's first (earliest-ending) match
+    matches = {}
+    
+    def on_match(pattern_id, start, end, flags, context):
+        needle = patterns[pattern_id]
+        matches[needle] = end - len(needle)
+    
+    db.scan(full_text_folded.encode('ascii'), match_event_handler=on_match)
+    return matches
+
+
+def locate_range(full_text_folded, text_segments, search_text, context_length=50, char_starts=None, exact_matches=None):
+    """
+    Find the start and end indices of text in an already fetched document.
+    
+    Args:
+        full_text_folded: Case-folded document text, from fetch_segments
+        text_segments: Segment lists (texts, starts, ends, blocks), from fetch_segments
+        search_text: Text to search for (can be partial - will find best match)
+        context_length: How many characters around the match to include
+        char_starts: Segment offsets from fetch_segments (computed if omitted)
+        exact_matches: Result of find_exact_matches covering search_text (searched here if omitted)
+    
+    Returns:
+        tuple: (start_index, end_index) or (None, None) if not found
+    """
+    texts, starts, ends, _ = text_segments
+    if not texts:
+        return (None, None)
+    
+    # Clean search text - remove extra whitespace
+    search_folded = _normalize_search_text(search_text)
+    
+    # Try exact match first
+    if exact_matches is not None:
+        match_start = exact_matches.get(search_folded, -1)
+    else:
+        match_start = full_text_folded.find(search_folded)
+    if match_start != -1:
+        match_end = match_start + len(search_folded)
+    else:
+        # Try to find a substring match (for partial text)
+        # Find the longest substring that matches, at least 10 chars
+        match = difflib.SequenceMatcher(None, search_folded, full_text_folded, autojunk=False).find_longest_match(
+            0, len(search_folded), 0, len(full_text_folded)
+        )
+        
+        if match.size >= 10:
+            match_start = match.b
+            match_end = match.b + match.size
+        else:
+            # If no match found, return None
+            print(f"Warning: Could not find text '{search_text[:50]}...' in document", file=sys.stderr)
+            return (None, None)
+    
+    # Find the actual indices in the document: the match starts in the last segment
+    # starting at or before match_start, and ends in the last one starting before match_end
+    if char_starts is None:
+        char_starts = _segment_char_starts(texts)
+    
+    i = bisect.bisect_right(char_starts, match_start) - 1
+    start_index = starts[i] + (match_start - char_starts[i])
+    
+    i = bisect.bisect_left(char_starts, match_end) - 1
+    end_index = starts[i] + (match_end - char_starts[i])
+    
+    # Add some context around the match for better highlighting
+    if start_index:
+        start_index = max(1, start_index - min(context_length, start_index - 1))
+    if end_index:
+        # Get document end to ensure we don't exceed it
+        doc_end = ends[-1]
+        end_index = min(doc_end, end_index + context_length)
+    
+    return (start_index, end_index)
+
+
+def find_text_range(doc_service, doc_id, search_text, context_length=50, segments=None):
     """
     Find the start and end indices of text in a Google Doc.
     Returns (start_index, end_index) tuple.
@@ -110,86 +392,16 @@ def find_text_range(doc_service, doc_id, search_text, context_length=50):
         doc_id: Document ID
         search_text: Text to search for (can be partial - will find best match)
         context_length: How many characters around the match to include
+        segments: Optional result of fetch_segments to search instead of re-fetching the document
     
     Returns:
         tuple: (start_index, end_index) or (None, None) if not found
     """
     try:
-        doc = doc_service.documents().get(documentId=doc_id).execute()
-        text_segments = extract_text_with_indices(doc)
-        
-        if not text_segments:
-            return (None, None)
-        
-        # Build full text for searching
-        full_text = ''.join(seg['text'] for seg in text_segments)
-        
-        # Clean search text - remove extra whitespace
-        search_clean = ' '.join(search_text.split())
-        search_lower = search_clean.lower()
-        full_text_lower = full_text.lower()
-        
-        # Try exact match first
-        if search_lower in full_text_lower:
-            match_start = full_text_lower.find(search_lower)
-            match_end = match_start + len(search_clean)
-        else:
-            # Try to find a substring match (for partial text)
-            # Find the longest substring that matches
-            best_match = None
-            best_length = 0
-            
-            for i in range(len(search_lower)):
-                for j in range(i + 10, len(search_lower) + 1):  # At least 10 chars
-                    substring = search_lower[i:j]
-                    if substring in full_text_lower:
-                        if len(substring) > best_length:
-                            best_length = len(substring)
-                            best_match = full_text_lower.find(substring)
-            
-            if best_match is not None:
-                match_start = best_match
-                match_end = best_match + best_length
-            else:
-                # If no match found, return None
-                print(f"Warning: Could not find text '{search_text[:50]}...' in document", file=sys.stderr)
-                return (None, None)
-        
-        # Find the actual indices in the document
-        char_pos = 0
-        start_index = None
-        end_index = None
-        
-        for seg in text_segments:
-            seg_start = char_pos
-            seg_end = char_pos + len(seg['text'])
-            
-            # Check if match starts in this segment
-            if seg_start <= match_start < seg_end:
-                offset = match_start - seg_start
-                start_index = seg['start'] + offset
-            
-            # Check if match ends in this segment
-            if seg_start < match_end <= seg_end:
-                offset = match_end - seg_start
-                end_index = seg['start'] + offset
-                break
-            
-            char_pos = seg_end
-        
-        # If we found start but not end, use start + search length
-        if start_index and not end_index:
-            end_index = start_index + len(search_clean)
-        
-        # Add some context around the match for better highlighting
-        if start_index:
-            start_index = max(1, start_index - min(context_length, start_index - 1))
-        if end_index:
-            # Get document end to ensure we don't exceed it
-            doc_end = text_segments[-1]['end'] if text_segments else 1
-            end_index = min(doc_end, end_index + context_length)
-        
-        return (start_index, end_index)
+        if segments is None:
+            segments = fetch_segments(doc_service, doc_id)
+        _, full_text_folded, text_segments, char_starts = segments
+        return locate_range(full_text_folded, text_segments, search_text, context_length, char_starts)
     
     except Exception as e:
         print(f"Error finding text range: {e}", file=sys.stderr)
@@ -198,7 +410,7 @@ def find_text_range(doc_service, doc_id, search_text, context_length=50):
         return (None, None)
 
 
-def insert_comment(doc_service, doc_id, comment_text, location_text=None, start_index=None):
+def insert_comment(doc_service, doc_id, comment_text, location_text=None, start_index=None, segments=None):
     """
     Insert a single comment into Google Docs (legacy function - use insert_comments_batch for multiple).
     
@@ -208,10 +420,11 @@ def insert_comment(doc_service, doc_id, comment_text, location_text=None, start_
         comment_text: Text of the comment
         location_text: Text to search for to place comment (optional)
         start_index: Direct index to place comment (optional)
+        segments: Optional result of fetch_segments, reused instead of re-fetching the document
     """
     try:
         if start_index is None and location_text:
-            start_index, _ = find_text_range(doc_service, doc_id, location_text)
+            start_index, _ = find_text_range(doc_service, doc_id, location_text, segments=segments)
             if start_index is None:
                 start_index = 1  # Fallback
         elif start_index is None:
@@ -228,10 +441,10 @@ def insert_comment(doc_service, doc_id, comment_text, location_text=None, start_
         }]
         
         # Execute batch update
-        doc_service.documents().batchUpdate(
+        execute_write(doc_service.documents().batchUpdate(
             documentId=doc_id,
             body={'requests': requests}
-        ).execute()
+        ))
         
         return True
     
@@ -243,112 +456,185 @@ def insert_comment(doc_service, doc_id, comment_text, location_text=None, start_
         return False
 
 
-def insert_comments_batch(doc_id, comments, credentials=None):
+class OrjsonModel(JsonModel):
+    """googleapiclient JSON model that parses responses with orjson."""
+    
+    def deserialize(self, content):
+        body = orjson.loads(content)
+        if self._data_wrapper and 'data' in body:
+            body = body['data']
+        return body
+
+
+def build_docs_service(credentials=None):
     """
-    Insert multiple comments into a Google Doc with proper text range anchoring.
+    Build a Docs v1 service from credentials or an API key, using the discovery
+    document bundled with googleapiclient instead of fetching it.
+    """
+    model = OrjsonModel() if ORJSON_AVAILABLE else None
+    if isinstance(credentials, str):
+        return build('docs', 'v1', developerKey=credentials, model=model, static_discovery=True, cache_discovery=False)
+    return build('docs', 'v1', credentials=credentials, model=model, static_discovery=True, cache_discovery=False)
+
+
+def build_comment_requests(comments, segments=None):
+    """
+    Build the batchUpdate requests (highlight + comment) for a list of comments.
     
     Args:
-        doc_id: Google Docs document ID
         comments: List of comment dictionaries with 'text', 'location', 'suggestion'
-        credentials: Google API credentials
+        segments: Result of fetch_segments for the document; required if any comment has a location
     
     Returns:
-        bool: Success status
+        list: batchUpdate request dictionaries
     """
-    try:
-        if isinstance(credentials, str):
-            service = build('docs', 'v1', developerKey=credentials)
-        else:
-            service = build('docs', 'v1', credentials=credentials)
+    requests = []
+    
+    # Document indices where a table cell or section starts or ends; a highlight
+    # range crossing one of these makes the whole batchUpdate fail
+    block_edges = []
+    doc_end = 1
+    if segments:
+        _, starts, ends, blocks = segments[2]
+        block_edges = [
+            starts[i] for i in range(1, len(blocks))
+            if blocks[i] != blocks[i - 1]
+        ]
+        if ends:
+            doc_end = ends[-1]
+    
+    # Locate every comment's exact match in a single pass when pyahocorasick or hyperscan is installed
+    exact_matches = None
+    if segments and (AHOCORASICK_AVAILABLE or HYPERSCAN_AVAILABLE):
+        exact_matches = find_exact_matches(segments[1], [comment.get('location', '') for comment in comments])
+    
+    # Comments often share an anchor: locate each distinct location once, highlight it once
+    ranges = {}
+    highlighted = set()
+    
+    for comment in comments:
+        location_text = comment.get('location', '')
+        comment_text = comment.get('text', '')
+        suggestion = comment.get('suggestion', '')
         
-        # Build requests for all comments
-        requests = []
-        successful_comments = 0
+        # Combine text and suggestion
+        full_comment = comment_text
+        if suggestion:
+            full_comment += f"\n\nSuggestion: {suggestion}"
         
-        for comment in comments:
-            location_text = comment.get('location', '')
-            comment_text = comment.get('text', '')
-            suggestion = comment.get('suggestion', '')
-            
-            # Combine text and suggestion
-            full_comment = comment_text
-            if suggestion:
-                full_comment += f"\n\nSuggestion: {suggestion}"
+        # Find text range for anchoring the comment
+        if location_text:
+            if location_text not in ranges:
+                _, full_text_folded, text_segments, char_starts = segments
+                ranges[location_text] = locate_range(full_text_folded, text_segments, location_text, char_starts=char_starts, exact_matches=exact_matches)
+            start_index, end_index = ranges[location_text]
             
-            # Find text range for anchoring the comment
-            if location_text:
-                start_index, end_index = find_text_range(service, doc_id, location_text)
-                
-                if start_index is None or end_index is None:
-                    # Fallback: use a simple index if text not found
-                    print(f"Warning: Could not find location '{location_text[:50]}...' for comment, using document start", file=sys.stderr)
-                    start_index = 1
-                    end_index = 1
-            else:
-                # No location specified, use document start
+            if start_index is None or end_index is None:
+                # Fallback: use a simple index if text not found
+                print(f"Warning: Could not find location '{location_text[:50]}...' for comment, using document start", file=sys.stderr)
                 start_index = 1
                 end_index = 1
-            
-            # Create comment request with proper structure
-            # Google Docs API requires a range for comments to be anchored to text
-            comment_request = {
-                'createComment': {
-                    'location': {
-                        'index': start_index
-                    },
-                    'content': full_comment
-                }
+        else:
+            # No location specified, use document start
+            start_index = 1
+            end_index = 1
+        
+        # Create comment request with proper structure
+        # Google Docs API requires a range for comments to be anchored to text
+        comment_request = {
+            'createComment': {
+                'location': {
+                    'index': start_index
+                },
+                'content': full_comment
             }
-            
-            # If we have a range, we can optionally highlight the text
-            # Note: Comments are anchored to a location, highlighting is separate
-            if start_index != end_index and start_index > 1:
-                # Add a text style update to highlight the commented text
-                # This makes it easier to see what the comment refers to
-                highlight_request = {
-                    'updateTextStyle': {
-                        'range': {
-                            'startIndex': start_index,
-                            'endIndex': end_index
-                        },
-                        'textStyle': {
-                            'backgroundColor': {
-                                'color': {
-                                    'rgbColor': {
-                                        'red': 1.0,
-                                        'green': 0.9,
-                                        'blue': 0.0
-                                    }
+        }
+        
+        # The body's final newline cannot be styled
+        end_index = min(end_index, doc_end - 1)
+        
+        # If we have a range, we can optionally highlight the text
+        # Note: Comments are anchored to a location, highlighting is separate
+        crosses_block = bisect.bisect_right(block_edges, start_index) < bisect.bisect_left(block_edges, end_index)
+        if start_index < end_index and start_index > 1 and not crosses_block and (start_index, end_index) not in highlighted:
+            highlighted.add((start_index, end_index))
+            # Add a text style update to highlight the commented text
+            # This makes it easier to see what the comment refers to
+            highlight_request = {
+                'updateTextStyle': {
+                    'range': {
+                        'startIndex': start_index,
+                        'endIndex': end_index
+                    },
+                    'textStyle': {
+                        'backgroundColor': {
+                            'color': {
+                                'rgbColor': {
+                                    'red': 1.0,
+                                    'green': 0.9,
+                                    'blue': 0.0
                                 }
                             }
-                        },
-                        'fields': 'backgroundColor'
-                    }
+                        }
+                    },
+                    'fields': 'backgroundColor'
                 }
-                requests.append(highlight_request)
-            
-            requests.append(comment_request)
-            successful_comments += 1
+            }
+            requests.append(highlight_request)
+        
+        requests.append(comment_request)
+    
+    return requests
+
+
+def insert_comments_batch(doc_id, comments, credentials=None, use_cache=True, service=None):
+    """
+    Insert multiple comments into a Google Doc with proper text range anchoring.
+    
+    Args:
+        doc_id: Google Docs document ID
+        comments: List of comment dictionaries with 'text', 'location', 'suggestion'
+        credentials: Google API credentials
+        use_cache: If False, bypass the on-disk document cache
+        service: Optional Docs service to reuse across documents (built from credentials if omitted;
+                 don't share one between threads)
+    
+    Returns:
+        bool: Success status
+    """
+    try:
+        if service is None:
+            service = build_docs_service(credentials)
+        
+        # Fetch the document once; every comment is located in the same text
+        segments = fetch_segments(service, doc_id, use_cache) if any(comment.get('location') for comment in comments) else None
+        
+        # Build requests for all comments
+        requests = build_comment_requests(comments, segments)
+        successful_comments = len(comments)
         
         # Execute batch update
         if requests:
             try:
-                service.documents().batchUpdate(
+                execute_write(service.documents().batchUpdate(
                     documentId=doc_id,
                     body={'requests': requests}
-                ).execute()
+                ))
                 print(f"Successfully inserted {successful_comments} comments with highlighting", file=sys.stderr)
                 return True
             except HttpError as http_err:
+                # Still rate limited after backoff: dropping the highlights would not help
+                if _is_rate_limited(http_err):
+                    raise
                 # Try without highlighting if that fails
                 print(f"Error with highlighting, trying without: {http_err}", file=sys.stderr)
                 # Retry with just comments, no highlighting
                 comment_only_requests = [req for req in requests if 'createComment' in req]
                 if comment_only_requests:
-                    service.documents().batchUpdate(
+                    execute_write(service.documents().batchUpdate(
                         documentId=doc_id,
                         body={'requests': comment_only_requests}
-                    ).execute()
+                    ))
                     print(f"Successfully inserted {successful_comments} comments (without highlighting)", file=sys.stderr)
                     return True
                 raise
@@ -367,37 +653,136 @@ def insert_comments_batch(doc_id, comments, credentials=None):
         return False
 
 
+def insert_comments_for_many_docs(jobs, credentials=None, use_cache=True):
+    """
+    Insert comments into several Google Docs, sending all batchUpdate calls as one
+    batched HTTP request (split at the API's per-batch call limit).
+    
+    Args:
+        jobs: List of (doc_id, comments) pairs, comments shaped as for insert_comments_batch
+        credentials: Google API credentials
+        use_cache: If False, bypass the on-disk document cache
+    
+    Returns:
+        list: One success status per job, in order
+    """
+    service = build_docs_service(credentials)
+    results = [False] * len(jobs)
+    pending = []
+    
+    for i, (doc_id, comments) in enumerate(jobs):
+        try:
+            segments = fetch_segments(service, doc_id, use_cache) if any(comment.get('location') for comment in comments) else None
+            requests = build_comment_requests(comments, segments)
+        except Exception as e:
+            print(f"Error preparing comments for document {doc_id}: {e}", file=sys.stderr)
+            continue
+        if requests:
+            pending.append((i, doc_id, requests))
+        else:
+            results[i] = len(comments) > 0
+    
+    failed = []
+    rate_limited = []
+    
+    def on_response(request_id, response, exception):
+        i = int(request_id)
+        if exception is None:
+            results[i] = True
+        elif isinstance(exception, HttpError) and _is_rate_limited(exception):
+            rate_limited.append(i)
+        else:
+            failed.append(i)
+            print(f"Error with highlighting for document {jobs[i][0]}, trying without: {exception}", file=sys.stderr)
+    
+    for offset in range(0, len(pending), BATCH_HTTP_MAX_CALLS):
+        batch = service.new_batch_http_request(callback=on_response)
+        for i, doc_id, requests in pending[offset:offset + BATCH_HTTP_MAX_CALLS]:
+            batch.add(
+                service.documents().batchUpdate(documentId=doc_id, body={'requests': requests}),
+                request_id=str(i)
+            )
+        try:
+            batch.execute()
+        except HttpError as http_err:
+            print(f"HTTP Error inserting comments: {http_err}", file=sys.stderr)
+    
+    requests_by_job = {i: requests for i, _, requests in pending}
+    
+    # Rate-limited calls were not applied: send them again, one at a time with backoff
+    for i in rate_limited:
+        doc_id = jobs[i][0]
+        try:
+            execute_write(service.documents().batchUpdate(
+                documentId=doc_id,
+                body={'requests': requests_by_job[i]}
+            ))
+            results[i] = True
+        except HttpError as http_err:
+            if _is_rate_limited(http_err):
+                print(f"HTTP Error inserting comments into {doc_id}: {http_err}", file=sys.stderr)
+            else:
+                print(f"Error with highlighting for document {doc_id}, trying without: {http_err}", file=sys.stderr)
+                failed.append(i)
+    
+    # Same fallback as insert_comments_batch: retry failed documents with just comments
+    for i in failed:
+        doc_id = jobs[i][0]
+        comment_only_requests = [req for req in requests_by_job[i] if 'createComment' in req]
+        try:
+            execute_write(service.documents().batchUpdate(
+                documentId=doc_id,
+                body={'requests': comment_only_requests}
+            ))
+            results[i] = True
+        except HttpError as http_err:
+            print(f"HTTP Error inserting comments into {doc_id}: {http_err}", file=sys.stderr)
+    
+    print(f"Inserted comments into {sum(results)} of {len(jobs)} documents", file=sys.stderr)
+    return results
+
+
+def load_comments_file(comments_file):
+    """Load a comments JSON file: a list, a {"comments": [...]} object, or a single comment."""
+    with open(comments_file, 'r', encoding='utf-8') as f:
+        comments_data = json.load(f)
+    
+    # Handle both list and dict formats
+    if isinstance(comments_data, dict) and 'comments' in comments_data:
+        return comments_data['comments']
+    if isinstance(comments_data, list):
+        return comments_data
+    return [comments_data]
+
+
 def main():
     """Main function for command-line usage."""
-    if len(sys.argv) < 3:
-        print("Usage: python insert_comments.py <document_id> <comments_json_file>", file=sys.stderr)
-        sys.exit(1)
+    args = [arg for arg in sys.argv[1:] if arg != '--no-cache']
+    use_cache = len(args) == len(sys.argv) - 1
     
-    doc_id = sys.argv[1]
-    comments_file = sys.argv[2]
+    if len(args) < 2 or len(args) % 2:
+        print("Usage: python insert_comments.py [--no-cache] <document_id> <comments_json_file> [<document_id> <comments_json_file> ...]", file=sys.stderr)
+        sys.exit(1)
     
     try:
         # Load comments
-        with open(comments_file, 'r', encoding='utf-8') as f:
-            comments_data = json.load(f)
-        
-        # Handle both list and dict formats
-        if isinstance(comments_data, dict) and 'comments' in comments_data:
-            comments = comments_data['comments']
-        elif isinstance(comments_data, list):
-            comments = comments_data
-        else:
-            comments = [comments_data]
+        jobs = [(args[i], load_comments_file(args[i + 1])) for i in range(0, len(args), 2)]
         
         # Get credentials
         credentials = get_credentials()
         
-        # Insert comments
-        success = insert_comments_batch(doc_id, comments, credentials)
-        
-        if success:
-            print(f"Successfully inserted {len(comments)} comments")
+        # Insert comments; several documents share one batched HTTP request
+        if len(jobs) == 1:
+            doc_id, comments = jobs[0]
+            success = insert_comments_batch(doc_id, comments, credentials, use_cache)
+            if success:
+                print(f"Successfully inserted {len(comments)} comments")
         else:
+            results = insert_comments_for_many_docs(jobs, credentials, use_cache)
+            success = all(results)
+            print(f"Inserted comments into {sum(results)} of {len(jobs)} documents")
+        
+        if not success:
             print("Failed to insert comments", file=sys.stderr)
             sys.exit(1)
     
@@ -408,4 +793,3 @@ def main():
 
 if __name__ == "__main__":
     main()
-
@@ -3,385 +3,389 @@ Insert structured feedback text into Google Docs on a new page.
 """
 import os
 import sys
-from google.oauth2.credentials import Credentials
-from google.oauth2 import service_account
+import json
+import time
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import httplib2
+from google.auth.exceptions import GoogleAuthError
 from googleapiclient.discovery import build
 from googleapiclient.errors import HttpError
 
+try:
+    import orjson
+    ORJSON_AVAILABLE = True
+except ImportError:
+    ORJSON_AVAILABLE = False
 
-def get_credentials():
-    """Get Google API credentials from OAuth2 token, service account, or API key."""
-    from pathlib import Path
-    from google.oauth2.credentials import Credentials
-    from google.auth.transport.requests import Request
+# Add scripts directory to path for imports
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from _google_auth import get_credentials
+
+
+logger = logging.getLogger(__name__)
+
+# Failures a page insert reports and returns False for: API errors, credential
+# refresh failures, and network errors. Anything else is a bug and propagates.
+DOCS_WRITE_ERRORS = (HttpError, GoogleAuthError, httplib2.HttpLib2Error, OSError)
+
+# documents().get fields mask: just enough to find where the body ends, and at which revision
+END_INDEX_FIELDS = 'revisionId,body(content(endIndex))'
+
+# Retries (with backoff) for reads on 429/5xx; batchUpdate is not retried, since a
+# repeated insert would add the page twice
+GET_NUM_RETRIES = 3
+
+# Attempts at a page insert whose revision went stale between the get and the batchUpdate
+WRITE_ATTEMPTS = 2
+
+# Docs API write quota per user; batchUpdates from this process are paced to stay under it
+WRITES_PER_MINUTE = int(os.getenv('GRADER_DOCS_WRITES_PER_MINUTE', '60'))
+
+# Documents written at once by insert_feedback_batch (the work is round-trip bound)
+FEEDBACK_BATCH_WORKERS = 8
+
+# Token bucket shared by every thread that writes to Docs
+_write_tokens = float(WRITES_PER_MINUTE)
+_write_refilled_at = time.monotonic()
+_write_lock = threading.Lock()
+
+# Section headings on the feedback page, in order
+FEEDBACK_SECTIONS = ("Strengths", "Key Issues", "Suggestions for Improvement")
+
+# Style values shared by every feedback request (serialized as-is, never mutated)
+_FEEDBACK_HIGHLIGHT = {'color': {'rgbColor': {'red': 1.0, 'green': 0.95, 'blue': 0.8}}}  # Light yellow
+BODY_FONT_SIZE = {'magnitude': 12, 'unit': 'PT'}
+
+# The last Docs service built on each thread, reused while the credentials are unchanged
+# (googleapiclient services are not thread-safe, so they are never shared across threads)
+_thread_local = threading.local()
+
+
+def get_docs_service(credentials=None):
+    """
+    Return a Docs v1 service for credentials or an API key, built from the
+    discovery document bundled with googleapiclient and reused on this thread.
+    """
+    cached = getattr(_thread_local, 'docs_service', None)
+    # Credentials objects compare by identity, API key strings by value
+    if cached is not None and cached[0] == credentials:
+        return cached[1]
+    if isinstance(credentials, str):
+        service = build('docs', 'v1', developerKey=credentials, static_discovery=True, cache_discovery=False)
+    else:
+        service = build('docs', 'v1', credentials=credentials, static_discovery=True, cache_discovery=False)
+    _thread_local.docs_service = (credentials, service)
+    return service
+
+
+def get_insert_index(service, doc_id):
+    """
+    Find where new pages go: the index just before the end of the document body.
     
-    project_root = Path(__file__).parent.parent
+    Returns:
+        tuple: (insert_index, revision_id)
+    """
+    # Get document end index (only the top-level end indices are fetched)
+    doc = service.documents().get(documentId=doc_id, fields=END_INDEX_FIELDS).execute(num_retries=GET_NUM_RETRIES)
+    body = doc.get('body', {})
+    content = body.get('content', [])
     
-    # Priority 1: OAuth2 credentials (for accessing user's own Drive)
-    token_file = project_root / 'token.json'
-    if token_file.exists():
-        try:
-            # Load token without specifying scopes to avoid scope mismatch errors
-            creds = Credentials.from_authorized_user_file(str(token_file))
-            if creds and creds.valid:
-                return creds
-            # If expired, try to refresh
-            if creds and creds.expired and creds.refresh_token:
-                creds.refresh(Request())
-                # Save refreshed token
-                with open(token_file, 'w') as token:
-                    token.write(creds.to_json())
-                return creds
-        except Exception as e:
-            print(f"Error loading OAuth token: {e}", file=sys.stderr)
+    # The last structural element always has the largest end index
+    end_index = content[-1].get('endIndex', 1) if content else 1
     
-    # Priority 2: Service account
-    creds_path = os.getenv('GOOGLE_CREDENTIALS_PATH')
-    if creds_path and os.path.exists(creds_path):
-        return service_account.Credentials.from_service_account_file(
-            creds_path,
-            scopes=['https://www.googleapis.com/auth/documents',
-                   'https://www.googleapis.com/auth/drive']
-        )
+    # Insert before the end
+    insert_index = max(1, end_index - 1)
+    return insert_index, doc.get('revisionId')
+
+
+def wait_for_write_slot():
+    """Block until a batchUpdate fits in the per-minute write quota."""
+    global _write_tokens, _write_refilled_at
+    rate = WRITES_PER_MINUTE / 60.0
+    with _write_lock:
+        while True:
+            now = time.monotonic()
+            _write_tokens = min(WRITES_PER_MINUTE, _write_tokens + (now - _write_refilled_at) * rate)
+            _write_refilled_at = now
+            if _write_tokens >= 1:
+                _write_tokens -= 1
+                return
+            # Waiters queue on the lock, so slots are handed out in order
+            time.sleep((1 - _write_tokens) / rate)
+
+
+def _is_revision_mismatch(error):
+    """Whether an HttpError is the 400 a stale requiredRevisionId is rejected with."""
+    return error.resp.status == 400 and b'revision' in (error.content or b'').lower()
+
+
+def insert_pages(service, doc_id, build_requests):
+    """
+    Append pages at the end of a document with one batchUpdate.
     
-    # Priority 3: API key (limited access)
-    api_key = os.getenv('GOOGLE_API_KEY')
-    if not api_key:
-        raise ValueError("No authentication method available. Please set up OAuth2, service account, or API key.")
+    The requests are tied to the revision their indices were computed from, so a
+    concurrent edit fails the update instead of misplacing text; the end index is
+    then fetched again and the requests rebuilt.
     
-    return api_key
+    Args:
+        service: Google Docs API service
+        doc_id: Google Docs document ID
+        build_requests: Function taking the insert index and returning batchUpdate requests
+    """
+    for attempt in range(WRITE_ATTEMPTS):
+        insert_index, revision_id = get_insert_index(service, doc_id)
+        body = {'requests': build_requests(insert_index)}
+        if revision_id:
+            body['writeControl'] = {'requiredRevisionId': revision_id}
+        wait_for_write_slot()
+        try:
+            service.documents().batchUpdate(documentId=doc_id, body=body).execute()
+            return
+        except HttpError as error:
+            # Any other 400 is a bad request that would fail the same way again
+            if not _is_revision_mismatch(error) or not revision_id or attempt == WRITE_ATTEMPTS - 1:
+                raise
+            print(f"Document {doc_id} changed while inserting, retrying: {error}", file=sys.stderr)
 
 
-def insert_feedback_text(doc_id, strengths, key_issues, suggestions, credentials=None, page_title="Feedback"):
+def paragraph_style_request(text_range, named_style):
+    """Request that sets the named style of every paragraph overlapping text_range."""
+    return {
+        'updateParagraphStyle': {
+            'range': text_range,
+            'paragraphStyle': {
+                'namedStyleType': named_style
+            },
+            'fields': 'namedStyleType'
+        }
+    }
+
+
+def _heading_requests(text_range, named_style):
+    """Requests that give a title or heading its named paragraph style and the feedback highlight."""
+    return (
+        paragraph_style_request(text_range, named_style),
+        {
+            'updateTextStyle': {
+                'range': text_range,
+                'textStyle': {
+                    'backgroundColor': _FEEDBACK_HIGHLIGHT
+                },
+                'fields': 'backgroundColor'
+            }
+        },
+    )
+
+
+def build_feedback_requests(insert_index, strengths, key_issues, suggestions, page_title="Feedback"):
     """
-    Insert structured feedback text into Google Docs on a new page.
+    Build the batchUpdate requests that add the feedback page at insert_index.
     
     Args:
-        doc_id: Google Docs document ID
+        insert_index: Document index to insert the page break at (see get_insert_index)
         strengths: Text describing strengths
         key_issues: Text describing key issues
         suggestions: Text with suggestions for improvement
-        credentials: Google API credentials
         page_title: Title for the feedback page
     
     Returns:
-        bool: Success status
+        list: batchUpdate request dictionaries
     """
-    try:
-        if isinstance(credentials, str):
-            service = build('docs', 'v1', developerKey=credentials)
-        else:
-            service = build('docs', 'v1', credentials=credentials)
-        
-        # Get document end index
-        doc = service.documents().get(documentId=doc_id).execute()
-        body = doc.get('body', {})
-        content = body.get('content', [])
-        
-        # Calculate end index
-        end_index = 1
-        for element in content:
-            if 'endIndex' in element:
-                end_index = max(end_index, element['endIndex'])
-        
-        # Insert before the end
-        insert_index = max(1, end_index - 1)
-        
-        requests = []
-        
+    # Lay out the whole page first: the title, then each non-empty section.
+    # Style ranges are computed against this final layout.
+    # The page break's paragraph still holds the student's last line, so the page
+    # text starts with a newline that ends it; the title gets a paragraph of its own.
+    anchor = insert_index + 1  # After the page break
+    title_start = anchor + 1
+    title_text = f"\n{page_title}\n\n"
+    texts = [title_text]
+    
+    # Non-empty sections, each body stripped once
+    sections = [
+        (heading, section_body.strip())
+        for heading, section_body in zip(FEEDBACK_SECTIONS, (strengths, key_issues, suggestions))
+        if section_body and section_body.strip()
+    ]
+    
+    # One pass for the section text and its (heading_range, content_range) offsets
+    section_ranges = []
+    current_index = anchor + len(title_text)
+    for heading, section_body in sections:
+        texts.append(f"{heading}\n{section_body}\n\n")
+        heading_end = current_index + len(heading)
+        content_start = heading_end + 1  # After the heading's newline
+        content_end = content_start + len(section_body)
+        section_ranges.append((
+            {'startIndex': current_index, 'endIndex': heading_end},
+            {'startIndex': content_start, 'endIndex': content_end}
+        ))
+        current_index = content_end + 2  # Past the section's trailing \n\n
+    
+    title_range = {
+        'startIndex': title_start,
+        'endIndex': title_start + len(page_title)
+    }
+    
+    # New paragraphs inherit the style of the one they were split from
+    page_range = {
+        'startIndex': title_start,
+        'endIndex': current_index
+    }
+    
+    return [
         # Insert page break
-        requests.append({
+        {
             'insertPageBreak': {
                 'location': {
                     'index': insert_index
                 }
             }
-        })
-        
-        # Update end index after page break
-        end_index = insert_index + 1
-        
-        # Insert title
-        title_text = f"{page_title}\n\n"
-        requests.append({
+        },
+        # Insert the whole page as one text run, then style it
+        {
             'insertText': {
                 'location': {
-                    'index': end_index
-                },
-                'text': title_text
-            }
-        })
-        
-        # Style the title with highlighting
-        title_end = end_index + len(page_title)
-        requests.append({
-            'updateTextStyle': {
-                'range': {
-                    'startIndex': end_index,
-                    'endIndex': title_end
-                },
-                'textStyle': {
-                    'bold': True,
-                    'fontSize': {
-                        'magnitude': 14,
-                        'unit': 'PT'
-                    },
-                    'backgroundColor': {
-                        'color': {
-                            'rgbColor': {
-                                'red': 1.0,
-                                'green': 0.95,
-                                'blue': 0.8  # Light yellow highlight
-                            }
-                        }
-                    }
+                    'index': anchor
                 },
-                'fields': 'bold,fontSize,backgroundColor'
+                'text': ''.join(texts)
             }
-        })
-        
-        current_index = title_end
-        
-        # Insert Strengths section
-        if strengths and strengths.strip():
-            strengths_text = f"Strengths\n{strengths.strip()}\n\n"
-            strengths_start = current_index
-            requests.append({
-                'insertText': {
-                    'location': {
-                        'index': current_index
-                    },
-                    'text': strengths_text
-                }
-            })
-            
-            # Style section heading
-            strengths_heading_end = current_index + len("Strengths")
-            requests.append({
-                'updateTextStyle': {
-                    'range': {
-                        'startIndex': current_index,
-                        'endIndex': strengths_heading_end
-                    },
-                    'textStyle': {
-                        'bold': True,
-                        'fontSize': {
-                            'magnitude': 12,
-                            'unit': 'PT'
-                        },
-                        'backgroundColor': {
-                            'color': {
-                                'rgbColor': {
-                                    'red': 1.0,
-                                    'green': 0.95,
-                                    'blue': 0.8  # Light yellow highlight
-                                }
-                            }
-                        }
-                    },
-                    'fields': 'bold,fontSize,backgroundColor'
-                }
-            })
-            
-            # Highlight the content text and set font size to 12
-            strengths_content_start = strengths_heading_end + 1  # After "Strengths\n"
-            strengths_content_end = current_index + len(strengths_text) - 2  # -2 for the \n\n at end
-            if strengths_content_end > strengths_content_start:
-                requests.append({
+        },
+        # Reset the page to normal text before styling its headings
+        paragraph_style_request(page_range, 'NORMAL_TEXT'),
+        # Make the title a Heading 1 (sized and bolded by the document's named style) and highlight it
+        *_heading_requests(title_range, 'HEADING_1'),
+        # Section headings become Heading 2; their content is highlighted and set to 12pt
+        *[
+            request
+            for heading_range, content_range in section_ranges
+            for request in (
+                *_heading_requests(heading_range, 'HEADING_2'),
+                {
                     'updateTextStyle': {
-                        'range': {
-                            'startIndex': strengths_content_start,
-                            'endIndex': strengths_content_end
-                        },
+                        'range': content_range,
                         'textStyle': {
-                            'fontSize': {
-                                'magnitude': 12,
-                                'unit': 'PT'
-                            },
-                            'backgroundColor': {
-                                'color': {
-                                    'rgbColor': {
-                                        'red': 1.0,
-                                        'green': 0.95,
-                                        'blue': 0.8  # Light yellow highlight
-                                    }
-                                }
-                            }
+                            'fontSize': BODY_FONT_SIZE,
+                            'backgroundColor': _FEEDBACK_HIGHLIGHT
                         },
                         'fields': 'fontSize,backgroundColor'
                     }
-                })
-            
-            current_index += len(strengths_text)
-        
-        # Insert Key Issues section
-        if key_issues and key_issues.strip():
-            issues_text = f"Key Issues\n{key_issues.strip()}\n\n"
-            issues_start = current_index
-            requests.append({
-                'insertText': {
-                    'location': {
-                        'index': current_index
-                    },
-                    'text': issues_text
-                }
-            })
-            
-            # Style section heading
-            issues_heading_end = current_index + len("Key Issues")
-            requests.append({
-                'updateTextStyle': {
-                    'range': {
-                        'startIndex': current_index,
-                        'endIndex': issues_heading_end
-                    },
-                    'textStyle': {
-                        'bold': True,
-                        'fontSize': {
-                            'magnitude': 12,
-                            'unit': 'PT'
-                        },
-                        'backgroundColor': {
-                            'color': {
-                                'rgbColor': {
-                                    'red': 1.0,
-                                    'green': 0.95,
-                                    'blue': 0.8  # Light yellow highlight
-                                }
-                            }
-                        }
-                    },
-                    'fields': 'bold,fontSize,backgroundColor'
-                }
-            })
-            
-            # Highlight the content text and set font size to 12
-            issues_content_start = issues_heading_end + 1
-            issues_content_end = current_index + len(issues_text) - 2
-            if issues_content_end > issues_content_start:
-                requests.append({
-                    'updateTextStyle': {
-                        'range': {
-                            'startIndex': issues_content_start,
-                            'endIndex': issues_content_end
-                        },
-                        'textStyle': {
-                            'fontSize': {
-                                'magnitude': 12,
-                                'unit': 'PT'
-                            },
-                            'backgroundColor': {
-                                'color': {
-                                    'rgbColor': {
-                                        'red': 1.0,
-                                        'green': 0.95,
-                                        'blue': 0.8  # Light yellow highlight
-                                    }
-                                }
-                            }
-                        },
-                        'fields': 'fontSize,backgroundColor'
-                    }
-                })
-            
-            current_index += len(issues_text)
-        
-        # Insert Suggestions section
-        if suggestions and suggestions.strip():
-            suggestions_text = f"Suggestions for Improvement\n{suggestions.strip()}\n\n"
-            suggestions_start = current_index
-            requests.append({
-                'insertText': {
-                    'location': {
-                        'index': current_index
-                    },
-                    'text': suggestions_text
-                }
-            })
-            
-            # Style section heading
-            suggestions_heading_end = current_index + len("Suggestions for Improvement")
-            requests.append({
-                'updateTextStyle': {
-                    'range': {
-                        'startIndex': current_index,
-                        'endIndex': suggestions_heading_end
-                    },
-                    'textStyle': {
-                        'bold': True,
-                        'fontSize': {
-                            'magnitude': 12,
-                            'unit': 'PT'
-                        },
-                        'backgroundColor': {
-                            'color': {
-                                'rgbColor': {
-                                    'red': 1.0,
-                                    'green': 0.95,
-                                    'blue': 0.8  # Light yellow highlight
-                                }
-                            }
-                        }
-                    },
-                    'fields': 'bold,fontSize,backgroundColor'
-                }
-            })
-            
-            # Highlight the content text and set font size to 12
-            suggestions_content_start = suggestions_heading_end + 1
-            suggestions_content_end = current_index + len(suggestions_text) - 2
-            if suggestions_content_end > suggestions_content_start:
-                requests.append({
-                    'updateTextStyle': {
-                        'range': {
-                            'startIndex': suggestions_content_start,
-                            'endIndex': suggestions_content_end
-                        },
-                        'textStyle': {
-                            'fontSize': {
-                                'magnitude': 12,
-                                'unit': 'PT'
-                            },
-                            'backgroundColor': {
-                                'color': {
-                                    'rgbColor': {
-                                        'red': 1.0,
-                                        'green': 0.95,
-                                        'blue': 0.8  # Light yellow highlight
-                                    }
-                                }
-                            }
-                        },
-                        'fields': 'fontSize,backgroundColor'
-                    }
-                })
-            
-            current_index += len(suggestions_text)
+                },
+            )
+        ],
+    ]
+
+
+def insert_feedback_text(doc_id, strengths, key_issues, suggestions, credentials=None, page_title="Feedback"):
+    """
+    Insert structured feedback text into Google Docs on a new page.
+    
+    Args:
+        doc_id: Google Docs document ID
+        strengths: Text describing strengths
+        key_issues: Text describing key issues
+        suggestions: Text with suggestions for improvement
+        credentials: Google API credentials
+        page_title: Title for the feedback page
+    
+    Returns:
+        bool: Success status
+    """
+    try:
+        service = get_docs_service(credentials)
         
-        # Execute all requests
-        if requests:
-            service.documents().batchUpdate(
-                documentId=doc_id,
-                body={'requests': requests}
-            ).execute()
+        insert_pages(
+            service,
+            doc_id,
+            lambda insert_index: build_feedback_requests(insert_index, strengths, key_issues, suggestions, page_title)
+        )
         
         return True
     
-    except HttpError as error:
+    except DOCS_WRITE_ERRORS as error:
         print(f"Error inserting feedback: {error}", file=sys.stderr)
-        return False
-    except Exception as e:
-        print(f"Unexpected error: {e}", file=sys.stderr)
-        import traceback
-        traceback.print_exc()
+        logger.debug("Feedback insert into %s failed", doc_id, exc_info=True)
         return False
 
 
-if __name__ == "__main__":
-    import json
+def insert_feedback_batch(items, credentials=None, max_workers=FEEDBACK_BATCH_WORKERS):
+    """
+    Insert feedback pages into many documents concurrently.
+    
+    Each worker thread builds (and then reuses) its own Docs service; writes from all
+    workers share the WRITES_PER_MINUTE quota.
+    
+    Args:
+        items: Dictionaries with 'doc_id' (or 'document_id'), 'strengths', 'key_issues',
+               'suggestions' and optionally 'page_title'
+        credentials: Google API credentials (loaded once if not given)
+        max_workers: Documents written at once
+    
+    Returns:
+        list: Success status per item, in order
+    """
+    if credentials is None:
+        credentials = get_credentials()
+    
+    def insert_item(item):
+        doc_id = item.get('doc_id') or item.get('document_id')
+        if not doc_id:
+            print("Skipping feedback item without doc_id", file=sys.stderr)
+            return False
+        return insert_feedback_text(
+            doc_id,
+            item.get('strengths', ''),
+            item.get('key_issues', ''),
+            item.get('suggestions', ''),
+            credentials,
+            item.get('page_title', 'Feedback')
+        )
+    
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(insert_item, items))
+
+
+def read_stdin_payloads():
+    """
+    Read --stdin-json input: one JSON object, or NDJSON with one object per line.
+    
+    Returns:
+        list: Payload dictionaries
+    """
+    data = sys.stdin.buffer.read()
+    loads = orjson.loads if ORJSON_AVAILABLE else json.loads
+    try:
+        payload = loads(data)
+        return payload if isinstance(payload, list) else [payload]
+    except ValueError:
+        # More than one document: NDJSON
+        return [loads(line) for line in data.splitlines() if line.strip()]
+
+
+def main():
+    """Main function for command-line usage."""
+    if sys.argv[1:] == ['--stdin-json']:
+        # Payloads: {"doc_id", "strengths", "key_issues", "suggestions", "page_title"?}
+        try:
+            payloads = read_stdin_payloads()
+            credentials = get_credentials()
+        except Exception as e:
+            print(f"Error: {e}", file=sys.stderr)
+            sys.exit(1)
+        
+        results = insert_feedback_batch(payloads, credentials)
+        failed = results.count(False)
+        
+        print(f"Inserted feedback into {len(payloads) - failed} of {len(payloads)} documents")
+        if failed:
+            sys.exit(1)
+        return
     
     if len(sys.argv) < 5:
         print("Usage: python insert_feedback.py <document_id> <strengths> <key_issues> <suggestions>", file=sys.stderr)
+        print("       python insert_feedback.py --stdin-json < payload.json (or NDJSON)", file=sys.stderr)
         sys.exit(1)
     
     doc_id = sys.argv[1]
@@ -403,3 +407,6 @@ if __name__ == "__main__":
         print(f"Error: {e}", file=sys.stderr)
         sys.exit(1)
 
+
+if __name__ == "__main__":
+    main()
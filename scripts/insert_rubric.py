@@ -4,287 +4,175 @@ Insert rubric table into Google Docs on a new page.
 import os
 import sys
 import json
-from google.oauth2.credentials import Credentials
-from google.oauth2 import service_account
-from googleapiclient.discovery import build
-from googleapiclient.errors import HttpError
+import logging
 
+# Add scripts directory to path for imports
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
 
-def get_credentials():
-    """Get Google API credentials from OAuth2 token, service account, or API key."""
-    from pathlib import Path
-    from google.oauth2.credentials import Credentials
-    from google.auth.transport.requests import Request
-    
-    project_root = Path(__file__).parent.parent
-    
-    # Priority 1: OAuth2 credentials (for accessing user's own Drive)
-    token_file = project_root / 'token.json'
-    if token_file.exists():
-        try:
-            # Load token without specifying scopes to avoid scope mismatch errors
-            # The token already contains the scopes it was created with
-            creds = Credentials.from_authorized_user_file(str(token_file))
-            if creds and creds.valid:
-                return creds
-            # If expired, try to refresh
-            if creds and creds.expired and creds.refresh_token:
-                creds.refresh(Request())
-                # Save refreshed token
-                with open(token_file, 'w') as token:
-                    token.write(creds.to_json())
-                return creds
-        except Exception as e:
-            print(f"Error loading OAuth token: {e}", file=sys.stderr)
-    
-    # Priority 2: Service account
-    creds_path = os.getenv('GOOGLE_CREDENTIALS_PATH')
-    if creds_path and os.path.exists(creds_path):
-        return service_account.Credentials.from_service_account_file(
-            creds_path,
-            scopes=['https://www.googleapis.com/auth/documents',
-                   'https://www.googleapis.com/auth/drive']
-        )
-    
-    # Priority 3: API key (limited access)
-    api_key = os.getenv('GOOGLE_API_KEY')
-    if not api_key:
-        raise ValueError("No authentication method available. Please set up OAuth2, service account, or API key.")
-    
-    return api_key
+from googleapiclient.errors import HttpError
+from _google_auth import get_credentials
+from insert_feedback import BODY_FONT_SIZE, DOCS_WRITE_ERRORS, get_docs_service, insert_pages, wait_for_write_slot, paragraph_style_request, build_feedback_requests, insert_feedback_text, read_stdin_payloads
 
 
-def get_document_end_index(doc_service, doc_id):
-    """Get the index of the end of the document."""
-    try:
-        doc = doc_service.documents().get(documentId=doc_id).execute()
-        body = doc.get('body', {})
-        content = body.get('content', [])
-        
-        if not content:
-            return 1
-        
-        # Find the last element
-        last_element = content[-1]
-        
-        # Calculate end index
-        end_index = 1
-        for element in content:
-            if 'paragraph' in element:
-                para = element['paragraph']
-                for elem in para.get('elements', []):
-                    if 'textRun' in elem:
-                        end_index += len(elem['textRun'].get('content', ''))
-                end_index += 1  # Newline
-            elif 'table' in element:
-                # Approximate table size
-                end_index += 100
-        
-        return end_index
-    
-    except Exception as e:
-        print(f"Error getting document end: {e}", file=sys.stderr)
-        return 1
+logger = logging.getLogger(__name__)
 
+# Highlight shared by every rubric request (serialized as-is, never mutated)
+_RUBRIC_HIGHLIGHT = {'color': {'rgbColor': {'red': 0.9, 'green': 0.95, 'blue': 1.0}}}  # Light blue
 
-def insert_rubric_table(doc_id, rubric, scores, total_score, credentials=None, page_title="Grading Rubric", criterion_comments=None):
+
+def build_rubric_requests(insert_index, rubric, scores, total_score, page_title="Grading Rubric", criterion_comments=None):
     """
-    Insert a rubric as a formatted list into Google Docs on a new page.
+    Build the batchUpdate requests that add the rubric page at insert_index.
     
     Args:
-        doc_id: Google Docs document ID
+        insert_index: Document index to insert the page break at (see get_insert_index)
         rubric: Rubric dictionary with criteria
         scores: Dictionary of scores for each criterion
         total_score: Total score
-        credentials: Google API credentials
         page_title: Title for the rubric page
         criterion_comments: Dictionary of comments for each criterion
     
     Returns:
-        bool: Success status
+        list: batchUpdate request dictionaries
     """
-    try:
-        if isinstance(credentials, str):
-            service = build('docs', 'v1', developerKey=credentials)
+    # Lay out the page first: the title, then the rubric.
+    # Style ranges are computed against this final layout.
+    # The leading newline ends the page break's paragraph (which still holds the
+    # student's last line), so the title gets a paragraph of its own
+    anchor = insert_index + 1  # After the page break
+    title_start = anchor + 1
+    title_text = f"\n{page_title}\n\n"
+    title_end = title_start + len(page_title)
+    
+    # Build rubric text as a numbered list
+    rubric_text = "\n"
+    rubric_start_index = anchor + len(title_text)
+    
+    # Add criteria as numbered list items
+    for idx, criterion in enumerate(rubric['criteria'], start=1):
+        criterion_name = criterion['name']
+        max_points = criterion['max_points']
+        points_received = scores.get(criterion_name, 0)
+        
+        # Get comment for this criterion
+        comment = ""
+        if criterion_comments and criterion_name in criterion_comments:
+            comment = criterion_comments[criterion_name]
         else:
-            service = build('docs', 'v1', credentials=credentials)
-        
-        # Get document end index
-        doc = service.documents().get(documentId=doc_id).execute()
-        body = doc.get('body', {})
-        content = body.get('content', [])
-        
-        # Calculate end index - must be less than the actual end
-        end_index = 1
-        for element in content:
-            if 'endIndex' in element:
-                end_index = max(end_index, element['endIndex'])
-        
-        # The endIndex is the end of the segment, we need to insert before it
-        # Subtract 1 to ensure we're inserting before the end
-        insert_index = max(1, end_index - 1)
-        
-        requests = []
+            # Generate default comment
+            if points_received == max_points:
+                comment = "Full points - meets all requirements"
+            elif points_received == 0:
+                comment = "No points - does not meet requirements"
+            else:
+                comment = f"Partial credit - {points_received} out of {max_points} points"
         
+        # Format: "1. Criteria - Length | Comment - 1 page | Points received - 1"
+        rubric_text += f"{idx}. Criteria - {criterion_name} | Comment - {comment} | Points received - {points_received}\n"
+    
+    # Add total score
+    rubric_text += f"\nTotal Score - {total_score}\n"
+    rubric_end_index = rubric_start_index + len(rubric_text)
+    
+    title_range = {
+        'startIndex': title_start,
+        'endIndex': title_end
+    }
+    
+    # New paragraphs inherit the style of the one they were split from
+    page_range = {
+        'startIndex': title_start,
+        'endIndex': rubric_end_index
+    }
+    
+    return [
         # Insert page break - must be before the end index
-        requests.append({
+        {
             'insertPageBreak': {
                 'location': {
                     'index': insert_index
                 }
             }
-        })
-        
-        # Update end index after page break
-        end_index = insert_index + 1
-        
-        # Insert title
-        title_text = f"{page_title}\n\n"
-        requests.append({
+        },
+        # Insert the title and rubric as one text run, then style it
+        {
             'insertText': {
                 'location': {
-                    'index': end_index
+                    'index': anchor
                 },
-                'text': title_text
+                'text': title_text + rubric_text
             }
-        })
-        
-        # Style the title with highlighting
-        title_end = end_index + len(page_title)
-        requests.append({
+        },
+        # Reset the page to normal text, then make the title a Heading 1
+        # (sized and bolded by the document's named style)
+        paragraph_style_request(page_range, 'NORMAL_TEXT'),
+        paragraph_style_request(title_range, 'HEADING_1'),
+        # Highlight the title
+        {
             'updateTextStyle': {
-                'range': {
-                    'startIndex': end_index,
-                    'endIndex': title_end
-                },
+                'range': title_range,
                 'textStyle': {
-                    'bold': True,
-                    'fontSize': {
-                        'magnitude': 14,
-                        'unit': 'PT'
-                    },
-                    'backgroundColor': {
-                        'color': {
-                            'rgbColor': {
-                                'red': 0.9,
-                                'green': 0.95,
-                                'blue': 1.0  # Light blue highlight
-                            }
-                        }
-                    }
+                    'backgroundColor': _RUBRIC_HIGHLIGHT
                 },
-                'fields': 'bold,fontSize,backgroundColor'
+                'fields': 'backgroundColor'
             }
-        })
-        
-        end_index = end_index + len(title_text)
-        
-        # Build rubric text as a numbered list
-        rubric_text = "\n"
-        rubric_start_index = end_index
-        
-        # Add criteria as numbered list items
-        for idx, criterion in enumerate(rubric['criteria'], start=1):
-            criterion_name = criterion['name']
-            max_points = criterion['max_points']
-            points_received = scores.get(criterion_name, 0)
-            
-            # Get comment for this criterion
-            comment = ""
-            if criterion_comments and criterion_name in criterion_comments:
-                comment = criterion_comments[criterion_name]
-            else:
-                # Generate default comment
-                if points_received == max_points:
-                    comment = "Full points - meets all requirements"
-                elif points_received == 0:
-                    comment = "No points - does not meet requirements"
-                else:
-                    comment = f"Partial credit - {points_received} out of {max_points} points"
-            
-            # Format: "1. Criteria - Length | Comment - 1 page | Points received - 1"
-            rubric_text += f"{idx}. Criteria - {criterion_name} | Comment - {comment} | Points received - {points_received}\n"
-        
-        # Add total score
-        rubric_text += f"\nTotal Score - {total_score}\n"
-        
-        # Insert the rubric text
-        requests.append({
-            'insertText': {
-                'location': {
-                    'index': end_index
-                },
-                'text': rubric_text
-            }
-        })
-        
+        },
         # Highlight the entire rubric content and set font size to 12
-        rubric_end_index = end_index + len(rubric_text)
-        requests.append({
+        {
             'updateTextStyle': {
                 'range': {
                     'startIndex': rubric_start_index,
                     'endIndex': rubric_end_index - 1  # -1 to exclude the final newline
                 },
                 'textStyle': {
-                    'fontSize': {
-                        'magnitude': 12,
-                        'unit': 'PT'
-                    },
-                    'backgroundColor': {
-                        'color': {
-                            'rgbColor': {
-                                'red': 0.9,
-                                'green': 0.95,
-                                'blue': 1.0  # Light blue highlight
-                            }
-                        }
-                    }
+                    'fontSize': BODY_FONT_SIZE,
+                    'backgroundColor': _RUBRIC_HIGHLIGHT
                 },
                 'fields': 'fontSize,backgroundColor'
             }
-        })
+        },
+    ]
+
+
+def insert_rubric_table(doc_id, rubric, scores, total_score, credentials=None, page_title="Grading Rubric", criterion_comments=None):
+    """
+    Insert a rubric as a formatted list into Google Docs on a new page.
+    
+    Args:
+        doc_id: Google Docs document ID
+        rubric: Rubric dictionary with criteria
+        scores: Dictionary of scores for each criterion
+        total_score: Total score
+        credentials: Google API credentials
+        page_title: Title for the rubric page
+        criterion_comments: Dictionary of comments for each criterion
+    
+    Returns:
+        bool: Success status
+    """
+    try:
+        service = get_docs_service(credentials)
         
-        # Execute all requests
-        service.documents().batchUpdate(
-            documentId=doc_id,
-            body={'requests': requests}
-        ).execute()
+        insert_pages(
+            service,
+            doc_id,
+            lambda insert_index: build_rubric_requests(insert_index, rubric, scores, total_score, page_title, criterion_comments)
+        )
         
         return True
     
-    except HttpError as error:
+    except DOCS_WRITE_ERRORS as error:
         print(f"Error inserting rubric: {error}", file=sys.stderr)
+        logger.debug("Rubric insert into %s failed", doc_id, exc_info=True)
         # Fallback: try simpler text-based approach
         return insert_rubric_text_fallback(doc_id, rubric, scores, total_score, credentials, page_title)
-    except Exception as e:
-        print(f"Unexpected error: {e}", file=sys.stderr)
-        import traceback
-        traceback.print_exc()
-        return insert_rubric_text_fallback(doc_id, rubric, scores, total_score, credentials, page_title)
 
 
 def insert_rubric_text_fallback(doc_id, rubric, scores, total_score, credentials, page_title):
     """Fallback method: insert rubric as formatted text."""
     try:
-        if isinstance(credentials, str):
-            service = build('docs', 'v1', developerKey=credentials)
-        else:
-            service = build('docs', 'v1', credentials=credentials)
-        
-        # Get document end
-        doc = service.documents().get(documentId=doc_id).execute()
-        body = doc.get('body', {})
-        content = body.get('content', [])
+        service = get_docs_service(credentials)
         
-        end_index = 1
-        for element in content:
-            if 'endIndex' in element:
-                end_index = max(end_index, element['endIndex'])
-
-        # The endIndex is the end of the segment, we need to insert before it
-        insert_index = max(1, end_index - 1)
-
         # Build rubric text
         rubric_text = f"\n\n{page_title}\n\n"
         rubric_text += "=" * len(page_title) + "\n\n"
@@ -300,20 +188,23 @@ def insert_rubric_text_fallback(doc_id, rubric, scores, total_score, credentials
         
         rubric_text += f"\nTotal Points: {total_score} / {rubric['total_points']}\n"
         
+        # Append at the end of the body; nothing is styled, so no index (or
+        # documents().get) is needed
         requests = [
             {
                 'insertPageBreak': {
-                    'location': {'index': insert_index}
+                    'endOfSegmentLocation': {}
                 }
             },
             {
                 'insertText': {
-                    'location': {'index': insert_index + 1},
+                    'endOfSegmentLocation': {},
                     'text': rubric_text
                 }
             }
         ]
         
+        wait_for_write_slot()
         service.documents().batchUpdate(
             documentId=doc_id,
             body={'requests': requests}
@@ -321,15 +212,160 @@ def insert_rubric_text_fallback(doc_id, rubric, scores, total_score, credentials
         
         return True
     
-    except Exception as e:
+    except DOCS_WRITE_ERRORS as e:
         print(f"Error in fallback method: {e}", file=sys.stderr)
+        logger.debug("Rubric text fallback for %s failed", doc_id, exc_info=True)
         return False
 
 
+def insert_feedback_and_rubric(doc_id, feedback_data, rubric, credentials=None, feedback_title="Feedback", rubric_title="Grading Rubric"):
+    """
+    Insert the feedback page and the rubric page with one documents().get and one batchUpdate.
+    
+    Args:
+        doc_id: Google Docs document ID
+        feedback_data: Dictionary with 'strengths', 'key_issues', 'suggestions', 'scores', 'total_score', 'criterion_comments'
+        rubric: Rubric dictionary with criteria
+        credentials: Google API credentials
+        feedback_title: Title for the feedback page
+        rubric_title: Title for the rubric page
+    
+    Returns:
+        tuple: (feedback_success, rubric_success)
+    """
+    try:
+        service = get_docs_service(credentials)
+        
+        # Back to front: the rubric page is inserted and styled first, then the feedback
+        # page goes in at the same index ahead of it. Its inserts move the already styled
+        # rubric forward, so neither page's indices depend on the other's length.
+        def build_requests(insert_index):
+            return build_rubric_requests(
+                insert_index,
+                rubric,
+                feedback_data.get('scores', {}),
+                feedback_data.get('total_score', 0),
+                rubric_title,
+                feedback_data.get('criterion_comments', {})
+            ) + build_feedback_requests(
+                insert_index,
+                feedback_data.get('strengths', ''),
+                feedback_data.get('key_issues', ''),
+                feedback_data.get('suggestions', ''),
+                feedback_title
+            )
+        
+        insert_pages(service, doc_id, build_requests)
+        
+        return True, True
+    
+    except HttpError as e:
+        # Only a 400 means the combined write was rejected outright; after anything
+        # else it may have been applied, and inserting again would duplicate the pages
+        if e.resp.status != 400:
+            print(f"Error inserting feedback and rubric: {e}", file=sys.stderr)
+            logger.debug("Combined insert into %s failed", doc_id, exc_info=True)
+            return False, False
+        print(f"Error inserting feedback and rubric together, inserting separately: {e}", file=sys.stderr)
+        logger.debug("Combined insert into %s rejected", doc_id, exc_info=True)
+    except DOCS_WRITE_ERRORS as e:
+        print(f"Error inserting feedback and rubric: {e}", file=sys.stderr)
+        logger.debug("Combined insert into %s failed", doc_id, exc_info=True)
+        return False, False
+    
+    # Fallback: one batchUpdate per page (with the rubric's own text fallback)
+    feedback_success = insert_feedback_text(
+        doc_id,
+        feedback_data.get('strengths', ''),
+        feedback_data.get('key_issues', ''),
+        feedback_data.get('suggestions', ''),
+        credentials,
+        feedback_title
+    )
+    rubric_success = insert_rubric_table(
+        doc_id,
+        rubric,
+        feedback_data.get('scores', {}),
+        feedback_data.get('total_score', 0),
+        credentials,
+        rubric_title,
+        feedback_data.get('criterion_comments', {})
+    )
+    return feedback_success, rubric_success
+
+
+def parse_scores(scores_data):
+    """
+    Split a scores file's contents into per-criterion scores and a total.
+    
+    Returns:
+        tuple: (scores, total_score)
+    """
+    if not isinstance(scores_data, dict):
+        raise ValueError("Scores must be a dictionary")
+    if 'scores' in scores_data:
+        return scores_data['scores'], scores_data.get('total_score', 0)
+    return scores_data, sum(scores_data.values())
+
+
+def insert_rubric_payloads(payloads, credentials):
+    """
+    Insert one rubric per --stdin-json payload, reusing the credentials and Docs service.
+    
+    Each payload has doc_id, rubric (or rubric_path), scores (a scores dictionary,
+    optionally with total_score), and optional criterion_comments and page_title.
+    
+    Returns:
+        int: Number of payloads that failed
+    """
+    failed = 0
+    for payload in payloads:
+        doc_id = payload.get('doc_id') or payload.get('document_id')
+        try:
+            rubric = payload.get('rubric')
+            if rubric is None:
+                with open(payload['rubric_path'], 'r', encoding='utf-8') as f:
+                    rubric = json.load(f)
+            scores, total_score = parse_scores(payload.get('scores', {}))
+            success = bool(doc_id) and insert_rubric_table(
+                doc_id,
+                rubric,
+                scores,
+                payload.get('total_score', total_score),
+                credentials,
+                payload.get('page_title', 'Grading Rubric'),
+                payload.get('criterion_comments')
+            )
+        except (KeyError, OSError, ValueError) as e:
+            print(f"Invalid payload for {doc_id}: {e}", file=sys.stderr)
+            success = False
+        
+        if not success:
+            print(f"Failed to insert rubric table into {doc_id}", file=sys.stderr)
+            failed += 1
+    
+    return failed
+
+
 def main():
     """Main function for command-line usage."""
+    if sys.argv[1:] == ['--stdin-json']:
+        try:
+            payloads = read_stdin_payloads()
+            credentials = get_credentials()
+        except Exception as e:
+            print(f"Error: {e}", file=sys.stderr)
+            sys.exit(1)
+        
+        failed = insert_rubric_payloads(payloads, credentials)
+        print(f"Inserted rubric tables into {len(payloads) - failed} of {len(payloads)} documents")
+        if failed:
+            sys.exit(1)
+        return
+    
     if len(sys.argv) < 4:
         print("Usage: python insert_rubric.py <document_id> <rubric_json_file> <scores_json_file>", file=sys.stderr)
+        print("       python insert_rubric.py --stdin-json < payload.json (or NDJSON)", file=sys.stderr)
         sys.exit(1)
     
     doc_id = sys.argv[1]
@@ -345,15 +381,7 @@ def main():
         with open(scores_file, 'r', encoding='utf-8') as f:
             scores_data = json.load(f)
         
-        if isinstance(scores_data, dict):
-            if 'scores' in scores_data:
-                scores = scores_data['scores']
-                total_score = scores_data.get('total_score', 0)
-            else:
-                scores = scores_data
-                total_score = sum(scores.values())
-        else:
-            raise ValueError("Scores must be a dictionary")
+        scores, total_score = parse_scores(scores_data)
         
         # Get credentials
         credentials = get_credentials()
@@ -374,4 +402,3 @@ def main():
 
 if __name__ == "__main__":
     main()
-